@@ -39,6 +39,7 @@ class TMWebDriver:
         self.default_session_id = None  
         self.latest_session_id = None  
         self.last_cmd_time = 0
+        self.version = 0    # 会话增减/重连或执行过 JS 后加一，供调用方判断页面与标签页是否可能变化
         self.is_remote = socket.socket().connect_ex((host, port+1)) == 0
         if not self.is_remote:  
             self.start_ws_server()  
@@ -58,6 +59,7 @@ class TMWebDriver:
                 session = Session(session_id, session_info, queue.Queue())
                 print(f"Browser http connected: {session.url} (Session: {session_id})")  
                 self.sessions[session_id] = session
+                self.version += 1
             session = self.sessions[session_id]
             session.disconnect_at = None
             if session.type == 'http': msgQ = session.http_queue
@@ -147,6 +149,7 @@ class TMWebDriver:
     
     def _register_client(self, session_id: str, client: WebSocket, session_info) -> None:  
         is_new_session = session_id not in self.sessions
+        self.version += 1
 
         if is_new_session:
             session = Session(session_id, session_info, client)
@@ -169,10 +172,11 @@ class TMWebDriver:
     def _unregister_client(self, client: WebSocket) -> None:  
         for session in self.sessions.values():
             if session.ws_client == client:
-                session.mark_disconnected()
+                session.mark_disconnected(); self.version += 1
                 break  
     
     def execute_js(self, code, timeout=10.0, session_id=None, auto_switch_newtab=False) -> Any:  
+        self.version += 1
         if session_id is None: session_id = self.default_session_id  
         if self.is_remote:
             print('remote_execute_js')
@@ -1,4 +1,5 @@
-import json, re
+import json, re, copy, itertools, collections
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Any, Optional
 @dataclass
@@ -16,6 +17,9 @@ def try_call_generator(func, *args, **kwargs):
 class BaseHandler:
     def tool_before_callback(self, tool_name, args, response): pass
     def tool_after_callback(self, tool_name, args, response, ret): pass
+    def can_parallel(self, tool_name, args): return False   # 无副作用、互不依赖的工具可并发执行
+    def merge_next_prompts(self, prompts): return "\n".join(dict.fromkeys(p for p in prompts if p))
+    def on_new_turn(self, context_reset=False): pass   # 上一轮的 next_prompt 已送达模型；context_reset 表示模型侧历史被摘要/裁剪或换了后端
     def dispatch(self, tool_name, args, response):
         method_name = f"do_{tool_name}"
         if hasattr(self, method_name):
@@ -38,55 +42,185 @@ def exhaust(g):
         while True: next(g)
     except StopIteration as e: return e.value
 
+def fair_share(sizes, budget):
+    '''把 budget 公平分给各项（水位线分配）：需求小于均分额的项按需给，余量再均分给其余项'''
+    alloc, left = [0] * len(sizes), budget
+    pending = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    while pending:
+        share = left // len(pending)
+        i = pending[0]
+        if sizes[i] <= share: alloc[i] = sizes[i]; left -= sizes[i]; pending.pop(0)
+        else:
+            for i in pending: alloc[i] = share
+            break
+    return alloc
+
+def budget_json(data, budget=30000, max_str_len=None, max_depth=None, omit_str=' ... ', indent=None):
+    '''一次遍历直接输出 JSON，总长度约束在 budget 左右。每层先估计子项大小（估到预算即止）：
+    放得下就完整输出，否则按顺序保留能放下的子项，再用 fair_share 分配预算（小项完整、大项均分余量）。
+    超长字符串保留首尾，放不下的元素/键用标记代替，末尾附上省略统计。超过 max_depth 的容器按 str() 处理。
+    '''
+    st = collections.Counter()
+    jstr = lambda s: json.dumps(s, ensure_ascii=False)
+    sep = ', ' if indent is None else ','
+    pad = lambda level: '' if indent is None else '\n' + ' ' * (indent * level)
+    def norm(obj, depth):
+        if isinstance(obj, (dict, list, tuple)): return str(obj) if max_depth is not None and depth >= max_depth else obj
+        if obj is None or isinstance(obj, (str, int, float, bool)): return obj
+        obj = json_default(obj)
+        return norm(obj, depth) if isinstance(obj, list) else obj
+    def items(obj):
+        return obj.items() if isinstance(obj, dict) else zip(itertools.repeat(None), obj)
+    def head(key, level):
+        return pad(level) + ('' if key is None else jstr(str(key)) + ': ')
+    def size(obj, cap, depth, level):   # 序列化后的长度，超过 cap 即停止估计
+        obj = norm(obj, depth)
+        if isinstance(obj, str):   # 按转义后的长度计
+            if max_str_len and len(obj) >= max_str_len + len(omit_str) * 2:
+                return min(cap, len(jstr(f"{obj[:max_str_len//2]}{omit_str}{obj[-(max_str_len//2):]}")))
+            return cap if len(obj) + 2 > cap else min(cap, len(jstr(obj)))
+        if not isinstance(obj, (dict, list, tuple)): return len(jstr(obj))
+        total = 2 + len(pad(level)) * bool(obj)
+        for k, v in items(obj):
+            total += len(head(k, level + 1)) + len(sep) + size(v, cap - total, depth + 1, level + 1)
+            if total >= cap: return cap
+        return total
+    def clip(s, room):
+        limit = max_str_len or len(s)
+        if len(s) < limit + len(omit_str) * 2 and len(s) + 2 <= room:
+            j = jstr(s)
+            if len(j) <= room: return j
+        keep = max(min(room - 2 - len(omit_str), limit), 8)
+        while True:
+            if len(s) <= keep + len(omit_str): j, cut = jstr(s), 0
+            else: j, cut = jstr(f"{s[:keep//2]}{omit_str}{s[-(keep//2):]}"), len(s) - keep // 2 * 2
+            if len(j) <= room or keep <= 8: break
+            keep = max(8, keep * room // len(j) - 1)   # 引号、反斜杠、控制字符转义后变长，按比例收缩保留长度
+        if cut: st['strings'] += 1; st['chars'] += cut
+        return j
+    def emit(obj, bud, depth, level):
+        obj = norm(obj, depth)
+        if isinstance(obj, str): return clip(obj, bud)
+        if not isinstance(obj, (dict, list, tuple)): return jstr(obj)
+        is_dict, n = isinstance(obj, dict), len(obj)
+        if n == 0: return '{}' if is_dict else '[]'
+        used, shown = 2 + len(pad(level)), []
+        for k, v in items(obj):
+            h = head(k, level + 1); sz = size(v, bud, depth + 1, level + 1)
+            need = len(h) + len(sep) + min(sz, 80)   # 每项至少保留 80 字符才展示
+            if shown and used + need > bud: break
+            shown.append((h, v, sz)); used += need
+        while len(shown) < n and len(shown) > 1 and used > bud - 40:
+            h, _, sz = shown.pop(); used -= len(h) + len(sep) + min(sz, 80)
+        more = n - len(shown)
+        avail = max(bud - 2 - len(pad(level)) - sum(len(h) + len(sep) for h, _, _ in shown) - (40 if more else 0), 0)
+        shares = fair_share([sz for _, _, sz in shown], avail)
+        parts = [h + emit(v, s, depth + 1, level + 1) for (h, v, _), s in zip(shown, shares)]
+        if more:
+            st['keys' if is_dict else 'items'] += more
+            parts.append(pad(level + 1) + (f'"...": "+{more} more keys"' if is_dict else jstr(f"... +{more} more items")))
+        return ('{' if is_dict else '[') + sep.join(parts) + pad(level) + ('}' if is_dict else ']')
+    out = emit(data, budget, 0, 0)
+    if st:
+        notes = [f"{st['strings']} 个字符串截断共 {st['chars']} 字符" if st['strings'] else '',
+                 f"{st['items']} 个列表元素" if st['items'] else '', f"{st['keys']} 个键" if st['keys'] else '']
+        out += f"\n[已省略: {'，'.join(x for x in notes if x)}；如需完整内容请缩小范围或保存到文件后分段读取]"
+    return out
+
+def format_data(data):
+    return budget_json(data) if type(data) in [dict, list] else str(data)
+
+def collect(g):
+    outs = []
+    try: 
+        while True: outs.append(next(g))
+    except StopIteration as e: return outs, e.value
+
+def split_batches(handler, calls):
+    '''连续的可并发调用合并为一批，其余调用单独成批，保持原有顺序。calls 的元素为 (name, args, ...)'''
+    batches = []
+    for call in calls:
+        par = handler.can_parallel(call[0], call[1])
+        if par and batches and batches[-1][0]: batches[-1][1].append(call)
+        else: batches.append((par, [call]))
+    return [b for _, b in batches]
+
+def call_views(response, calls):
+    '''同一回复中的多个调用共享正文。为每个调用复制一份 response，附上 call_index（本轮第几个调用）和 calls（本轮全部 (name, args)），
+    工具据此把正文中的代码块等按顺序分给各次调用'''
+    views = []
+    for i in range(len(calls)):
+        v = copy.copy(response); v.call_index, v.calls = i, calls; views.append(v)
+    return views
+
 def get_pretty_json(data):
     if isinstance(data, dict) and "script" in data:
         data = data.copy()
         data["script"] = data["script"].replace("; ", ";\n  ")
     return json.dumps(data, indent=2, ensure_ascii=False).replace('\\n', '\n')
 
-def agent_runner_loop(client, system_prompt, user_input, handler, tools_schema, max_turns=15, verbose=True):
+def agent_runner_loop(client, system_prompt, user_input, handler, tools_schema, max_turns=15, verbose=True, max_workers=4):
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_input}
     ]
-    for turn in range(max_turns):
-        yield f"**LLM Running (Turn {turn+1}) ...**\n\n"
-        if (turn+1) % 10 == 0: client.last_tools = ''  # 每10轮重置一次工具描述，避免上下文过大导致的模型性能下降
-        response_gen = client.chat(messages=messages, tools=tools_schema)
-        response = yield from response_gen
-        if verbose: yield '\n\n'
-
-        if not response.tool_calls:
-            tool_name, args = 'no_tool', {}
-        else:
-            tool_call = response.tool_calls[0] 
-            tool_name = tool_call.function.name
-            args = json.loads(tool_call.function.arguments)
-
-        if tool_name == 'no_tool': pass
-        else: 
-            showarg = get_pretty_json(args)
-            if not verbose and len(showarg) > 200: showarg = showarg[:200] + ' ...'
-            yield f"🛠️ **正在调用工具:** `{tool_name}`  📥**参数:**\n````text\n{showarg}\n````\n" 
-        gen = handler.dispatch(tool_name, args, response)
-        if verbose:
-            yield '`````\n'
-            outcome = yield from gen
-            yield '`````\n'
-        else:
-            outcome = exhaust(gen)
-
-        if outcome.next_prompt is None: return {'result': 'CURRENT_TASK_DONE', 'data': outcome.data}
-        if outcome.should_exit: return {'result': 'EXITED', 'data': outcome.data}
-
-        next_prompt = ""
-        if outcome.data is not None: 
-            datastr = json.dumps(outcome.data, ensure_ascii=False, default=json_default) if type(outcome.data) in [dict, list] else str(outcome.data) 
-            next_prompt += f"<tool_result>\n{datastr}\n</tool_result>\n\n"
-        next_prompt += outcome.next_prompt
-        if (turn+1) % 5 == 0:
-            next_prompt += f"\n\n[DANGER] 已连续执行第 {turn+1} 轮。禁止无效重试。若无有效进展，必须切换策略：1. 探测物理边界 2. 请求用户协助。"
-        if (turn+1) % 25 == 0:
-            next_prompt += f"\n\n### [DANGER] 已连续执行第 {turn+1} 轮。你必须总结情况进行ask_user，不允许继续重试。"
-        messages = [{"role": "user", "content": next_prompt}]
-    return {'result': 'MAX_TURNS_EXCEEDED'}
\ No newline at end of file
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    epoch = None
+    try:
+        for turn in range(max_turns):
+            yield f"**LLM Running (Turn {turn+1}) ...**\n\n"
+            if (turn+1) % 10 == 0: client.last_tools = ''  # 每10轮重置一次工具描述，避免上下文过大导致的模型性能下降
+            response_gen = client.chat(messages=messages, tools=tools_schema)
+            response = yield from response_gen
+            if verbose: yield '\n\n'
+            handler.on_new_turn(getattr(client, 'context_epoch', 0) != epoch)
+            epoch = getattr(client, 'context_epoch', 0)
+
+            if not response.tool_calls: calls = [('no_tool', {})]
+            else: calls = [(tc.function.name, json.loads(tc.function.arguments)) for tc in response.tool_calls]
+            calls = [(n, a, v) for (n, a), v in zip(calls, call_views(response, calls))]
+
+            results = []
+            for batch in split_batches(handler, calls):
+                for tool_name, args, _ in batch:
+                    if tool_name == 'no_tool': continue
+                    showarg = get_pretty_json(args)
+                    if not verbose and len(showarg) > 200: showarg = showarg[:200] + ' ...'
+                    yield f"🛠️ **正在调用工具:** `{tool_name}`  📥**参数:**\n````text\n{showarg}\n````\n" 
+                if len(batch) == 1:
+                    tool_name, args, resp = batch[0]
+                    gen = handler.dispatch(tool_name, args, resp)
+                    if verbose:
+                        yield '`````\n'
+                        outcome = yield from gen
+                        yield '`````\n'
+                    else:
+                        outcome = exhaust(gen)
+                    results.append((tool_name, outcome))
+                else:
+                    futures = [pool.submit(collect, handler.dispatch(n, a, r)) for n, a, r in batch]
+                    for (tool_name, _, _), fut in zip(batch, futures):
+                        outs, outcome = fut.result()
+                        if verbose: yield '`````\n' + ''.join(map(str, outs)) + '`````\n'
+                        results.append((tool_name, outcome))
+                if any(o.next_prompt is None or o.should_exit for _, o in results): break
+
+            for _, outcome in results:
+                if outcome.next_prompt is None: return {'result': 'CURRENT_TASK_DONE', 'data': outcome.data}
+                if outcome.should_exit: return {'result': 'EXITED', 'data': outcome.data}
+
+            next_prompt = ""
+            datas = [(n, o.data) for n, o in results if o.data is not None]
+            if len(results) == 1 and datas:
+                next_prompt += f"<tool_result>\n{format_data(datas[0][1])}\n</tool_result>\n\n"
+            elif datas:
+                body = "\n".join(f"[{i}] {n}:\n{format_data(d)}" for i, (n, d) in enumerate(datas, 1))
+                next_prompt += f"<tool_result>\n{body}\n</tool_result>\n\n"
+            next_prompt += handler.merge_next_prompts([o.next_prompt for _, o in results]) if len(results) > 1 else results[0][1].next_prompt
+            if (turn+1) % 5 == 0:
+                next_prompt += f"\n\n[DANGER] 已连续执行第 {turn+1} 轮。禁止无效重试。若无有效进展，必须切换策略：1. 探测物理边界 2. 请求用户协助。"
+            if (turn+1) % 25 == 0:
+                next_prompt += f"\n\n### [DANGER] 已连续执行第 {turn+1} 轮。你必须总结情况进行ask_user，不允许继续重试。"
+            messages = [{"role": "user", "content": next_prompt}]
+        return {'result': 'MAX_TURNS_EXCEEDED'}
+    finally: pool.shutdown(wait=False)
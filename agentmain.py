@@ -5,15 +5,15 @@ if sys.stderr is None: sys.stderr = open(os.devnull, "w")
 elif hasattr(sys.stderr, 'reconfigure'): sys.stderr.reconfigure(errors='replace')
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from sidercall import SiderLLMSession, LLMSession, ToolClient, ClaudeSession
+from sidercall import SiderLLMSession, LLMSession, ToolClient, ClaudeSession, mykeys
 from agent_loop import agent_runner_loop, StepOutcome, BaseHandler
-from ga import GenericAgentHandler, smart_format, get_global_memory, format_error
+from ga import GenericAgentHandler, smart_format, get_global_memory, get_memory_snippets, format_error, read_cached
 
-with open('assets/tools_schema.json', 'r', encoding='utf-8') as f:
-    TS = f.read()
-    TOOLS_SCHEMA = json.loads(TS if os.name == 'nt' else TS.replace('powershell', 'bash'))
+def _parse_tools_schema(TS): return json.loads(TS if os.name == 'nt' else TS.replace('powershell', 'bash'))
+def get_tools_schema(): return read_cached('assets/tools_schema.json', _parse_tools_schema)
+TOOLS_SCHEMA = get_tools_schema()
 
-def get_system_prompt():
+def get_system_prompt(query=None):
     if not os.path.exists('memory'): os.makedirs('memory')
     if not os.path.exists('memory/global_mem.txt'):
         with open('memory/global_mem.txt', 'w', encoding='utf-8') as f: f.write('')
@@ -22,8 +22,9 @@ def get_system_prompt():
         if os.path.exists('assets/global_mem_insight_template.txt'):
             with open('assets/global_mem_insight_template.txt', 'r', encoding='utf-8') as f: content = f.read()
         with open('memory/global_mem_insight.txt', 'w', encoding='utf-8') as f: f.write(content)
-    with open('assets/sys_prompt.txt', 'r', encoding='utf-8') as f: prompt = f.read()
+    prompt = read_cached('assets/sys_prompt.txt')
     prompt += get_global_memory()
+    if query and mykeys.get('memory_inject_topk', 0) > 0: prompt += get_memory_snippets(query, mykeys['memory_inject_topk'])
     return prompt
 
 class GeneraticAgent:
@@ -32,7 +33,7 @@ class GeneraticAgent:
         from sidercall import sider_cookie, oai_configs, claude_configs
         llm_sessions = []
         for cfg in claude_configs.values():
-            llm_sessions += [ClaudeSession(api_key=cfg['apikey'], api_base=cfg['apibase'], model=cfg['model'])]
+            llm_sessions += [ClaudeSession(api_key=cfg['apikey'], api_base=cfg['apibase'], model=cfg['model'], prompt_cache=cfg.get('prompt_cache', True))]
         if sider_cookie: llm_sessions += [SiderLLMSession(default_model=x) for x in \
                                     ["gemini-3.0-flash", "claude-haiku-4.5", "kimi-k2"]]
         for cfg in oai_configs.values():
@@ -51,6 +52,10 @@ class GeneraticAgent:
         self.current_source = 'none'
         self.handler = None
         self.verbose = True
+        self.py_pool = None
+        if mykeys.get('code_run_pool', 0) > 0:
+            from pyworker import PyWorkerPool
+            self.py_pool = PyWorkerPool(mykeys['code_run_pool'], mykeys.get('code_run_preload', []))
 
     def next_llm(self, n=-1):
         self.llm_no = ((self.llm_no + 1) if n < 0 else n) % len(self.llmclient.backends)
@@ -81,12 +86,15 @@ class GeneraticAgent:
             rquery = smart_format(raw_query.replace('\n', ' '), max_str_len=200)
             self.history.append(f"[USER]: {rquery}")
             
-            sys_prompt = get_system_prompt()
-            handler = GenericAgentHandler(None, self.history, './temp')
+            sys_prompt = get_system_prompt(raw_query)
+            handler = GenericAgentHandler(None, self.history, './temp', 
+                                          persistent_python=mykeys.get('code_run_persistent', False), py_pool=self.py_pool,
+                                          persistent_shell=mykeys.get('code_run_shell_session', False),
+                                          print_anchor=mykeys.get('print_anchor', False))
             self.handler = handler
             self.llmclient.backend = self.llmclient.backends[self.llm_no]
             gen = agent_runner_loop(self.llmclient, sys_prompt, raw_query, 
-                                handler, TOOLS_SCHEMA, max_turns=40, verbose=self.verbose)
+                                handler, get_tools_schema(), max_turns=40, verbose=self.verbose)
             try:
                 full_response = ""; last_pos = 0
                 for chunk in gen:
@@ -99,6 +107,8 @@ class GeneraticAgent:
                 if '</file_content>' in full_response: full_response = re.sub(r'<file_content>\s*(.*?)\s*</file_content>', r'\n````\n<file_content>\n\1\n</file_content>\n````', full_response, flags=re.DOTALL)
                 display_queue.put({'done': full_response, 'source': source})
                 self.history = handler.history_info
+                if self.llmclient.backend in self.llmclient.backends:   # 本任务中可能已自动切换到备用后端
+                    self.llm_no = self.llmclient.backends.index(self.llmclient.backend)
             except Exception as e:
                 print(f"Backend Error: {format_error(e)}")
                 display_queue.put({'done': full_response + f'\n```\n{format_error(e)}\n```', 'source': source})
@@ -107,7 +117,9 @@ class GeneraticAgent:
                 self.stop_sig = False
                 self.current_source = 'none'
                 self.task_queue.task_done()
-                if self.handler is not None: self.handler.code_stop_signal.append(1)
+                if self.handler is not None: 
+                    self.handler.code_stop_signal.append(1)
+                    self.handler.close()
 
     
 if __name__ == '__main__':
@@ -0,0 +1,58 @@
+import os, sys, json, time, types, argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.modules.setdefault('mykey', types.ModuleType('mykey'))    # 只测拼接，不需要真实后端配置
+from sidercall import ToolClient, PROTOCOL_PROMPT
+
+# ToolClient._build_protocol_prompt 的微基准：与原先逐段 += 拼接、每轮 json.dumps 工具 schema 的写法对比。
+# 用法：python assets/bench_protocol_prompt.py [--runs 50]
+# 参考结果（assets/tools_schema.json，2 万字符系统提示，每条消息 3000 字符，--runs 200 平均，单位 ms）：
+#   消息数      1      10     100    400
+#   legacy    0.22   0.23   0.40   0.94
+#   current   0.015  0.026  0.18   0.76
+# 固定开销（schema 序列化）已消失；余下随消息数线性增长的部分是输出拷贝和按 token 估算 total_cd_tokens（legacy 只数字符）。
+
+class Backend:
+    default_model = "claude-opus"
+
+def legacy_build(client, messages, tools):
+    system_content = next((m['content'] for m in messages if m['role'].lower() == 'system'), "")
+    history_msgs = [m for m in messages if m['role'].lower() != 'system']
+    tool_instruction = ""
+    if tools:
+        tools_json = json.dumps(tools, ensure_ascii=False, separators=(',', ':'))
+        tool_instruction = PROTOCOL_PROMPT.format(tools_json=tools_json)
+        if client.auto_save_tokens and client.last_tools == tools_json:
+            tool_instruction = "\n### 工具库状态：持续有效（code_run/file_read等），**可正常调用**。调用协议沿用。\n"
+        else: client.total_cd_tokens = 0
+        client.last_tools = tools_json
+    prompt = ""
+    if system_content: prompt += f"=== SYSTEM ===\n{system_content}\n"
+    prompt += f"{tool_instruction}\n\n"
+    for m in history_msgs:
+        role = "USER" if m['role'] == 'user' else "ASSISTANT"
+        prompt += f"=== {role} ===\n{m['content']}\n\n"
+        client.total_cd_tokens += len(m['content'])
+    if client.total_cd_tokens > 6000: client.last_tools = ''
+    prompt += "=== ASSISTANT ===\n"
+    return prompt
+
+def bench(build, client, messages, tools, runs):
+    build(messages, tools)      # 预热：填充 schema/token 缓存
+    t0 = time.perf_counter()
+    for _ in range(runs): build(messages, tools)
+    return (time.perf_counter() - t0) / runs * 1000
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--runs', type=int, default=50)
+    ap.add_argument('--sizes', default='1,10,100,400')
+    args = ap.parse_args()
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools_schema.json'), encoding='utf-8') as f: tools = json.load(f)
+    print(f"{'messages':>8} {'legacy ms':>10} {'current ms':>11}")
+    for n in map(int, args.sizes.split(',')):
+        messages = [{"role": "system", "content": "S" * 20000}]
+        messages += [{"role": "user" if i % 2 == 0 else "assistant", "content": f"msg {i} " + "x" * 3000} for i in range(n)]
+        client = ToolClient([Backend()], auto_save_tokens=True)
+        old = bench(lambda m, t: legacy_build(client, m, t), client, messages, tools, args.runs)
+        new = bench(client._build_protocol_prompt, client, messages, tools, args.runs)
+        print(f"{n:>8} {old:>10.3f} {new:>11.3f}")
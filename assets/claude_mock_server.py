@@ -0,0 +1,82 @@
+import json, time, hashlib, argparse, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 离线测试 ClaudeSession 的本地替身：POST /v1/messages，按 SSE 流式返回，并模拟 Anthropic prompt caching。
+# 带 cache_control 的块是断点；断点处写入前缀哈希，之后的请求从每个断点向前最多回看 LOOKBACK 个块查找已缓存的最长前缀。
+# usage 中的 input_tokens / cache_creation_input_tokens / cache_read_input_tokens 与真实接口含义一致（token 按 4 字符粗估）。
+# 用法：python assets/claude_mock_server.py --port 8765，然后把 claude_config 的 apibase 指向 http://127.0.0.1:8765
+LOOKBACK = 20
+
+def _blocks(messages):
+    '''展开为 [(块内容, 是否断点)]，cache_control 本身不参与前缀哈希'''
+    out = []
+    for m in messages:
+        content = m.get('content')
+        if isinstance(content, str): content = [{"type": "text", "text": content}]
+        for b in content or []:
+            bp = 'cache_control' in b
+            b = {k: v for k, v in b.items() if k != 'cache_control'}
+            out.append((m.get('role', '') + json.dumps(b, ensure_ascii=False, sort_keys=True), bp))
+    return out
+
+class PromptCache:
+    def __init__(self, ttl=300, min_tokens=1024):
+        self.ttl, self.min_tokens = ttl, min_tokens
+        self.entries, self.lock = {}, threading.Lock()    # 前缀哈希 -> 过期时间
+
+    def usage(self, messages):
+        blocks = _blocks(messages)
+        hashes, tokens, h, t = [], [], hashlib.sha256(), 0
+        for text, _ in blocks:
+            h.update(text.encode('utf-8')); hashes.append(h.hexdigest())
+            t += max(1, len(text) // 4); tokens.append(t)
+        bps = [i for i, (_, bp) in enumerate(blocks) if bp]
+        now, hit = time.time(), -1
+        with self.lock:
+            for i in bps:
+                for j in range(i, max(-1, i - LOOKBACK), -1):
+                    exp = self.entries.get(hashes[j])
+                    if exp and exp > now: hit = max(hit, j); break
+            if hit >= 0: self.entries[hashes[hit]] = now + self.ttl    # 命中刷新 TTL
+            written = -1
+            for i in bps:
+                if i > hit and tokens[i] >= self.min_tokens: self.entries[hashes[i]] = now + self.ttl; written = i
+        read = tokens[hit] if hit >= 0 else 0
+        created = tokens[written] - read if written >= 0 else 0
+        total = tokens[-1] if tokens else 0
+        return {"input_tokens": total - read - created, "cache_creation_input_tokens": created, "cache_read_input_tokens": read}
+
+class Handler(BaseHTTPRequestHandler):
+    cache, reply = None, "OK"
+    def log_message(self, *args): pass
+    def _event(self, typ, **data):
+        self.wfile.write(f"event: {typ}\ndata: {json.dumps(dict(type=typ, **data), ensure_ascii=False)}\n\n".encode('utf-8'))
+        self.wfile.flush()
+    def do_POST(self):
+        if self.path.rstrip('/') != '/v1/messages': self.send_error(404); return
+        try: req = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError: self.send_error(400); return
+        usage = self.cache.usage(req.get('messages', []))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream'); self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        out_tokens = max(1, len(self.reply) // 4)
+        self._event("message_start", message={"id": f"msg_mock_{time.time_ns()}", "type": "message", "role": "assistant",
+                    "model": req.get('model', 'mock'), "content": [], "usage": dict(usage, output_tokens=1)})
+        self._event("content_block_start", index=0, content_block={"type": "text", "text": ""})
+        for i in range(0, len(self.reply), 16):
+            self._event("content_block_delta", index=0, delta={"type": "text_delta", "text": self.reply[i:i+16]})
+        self._event("content_block_stop", index=0)
+        self._event("message_delta", delta={"stop_reason": "end_turn"}, usage={"output_tokens": out_tokens})
+        self._event("message_stop")
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--port', type=int, default=8765)
+    ap.add_argument('--ttl', type=int, default=300)
+    ap.add_argument('--min-tokens', type=int, default=1024, help='短于此长度的前缀不缓存（与真实接口一致）')
+    ap.add_argument('--reply', default="OK")
+    args = ap.parse_args()
+    Handler.cache, Handler.reply = PromptCache(args.ttl, args.min_tokens), args.reply
+    print(f"claude mock server on http://127.0.0.1:{args.port}")
+    ThreadingHTTPServer(('127.0.0.1', args.port), Handler).serve_forever()
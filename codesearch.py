@@ -0,0 +1,242 @@
+import os, re, time, atexit, struct, hashlib, threading
+
+# 工作区全文检索。每个文件保存一个"三元组签名"(casefold 后内容所有3字节片段哈希到的位图)，
+# 查询时先用签名位与筛出候选文件，再只读取候选文件逐行确认，返回带行号的有界结果。
+# 索引按 (mtime, size) 增量更新并以定长二进制记录持久化到用户缓存目录（不用 pickle，不放在 agent 可写的工作目录），
+# 十万级文件的查询只需遍历内存中的位图。完整遍历有 refresh_interval 的节流；节流期间每次查询仍会 stat 已索引文件和目录，
+# 文件被外部修改就重新索引该文件，目录有增删就提前完整遍历，因此结果不会落后于 code_run/git/pip 等外部修改。
+try: from re import _parser as sre_parse
+except ImportError: import sre_parse
+try: import numpy as np
+except ImportError: np = None
+
+SKIP_DIRS = {'.git', '.svn', '.hg', '__pycache__', 'node_modules', '.venv', 'venv', '.mypy_cache',
+             '.pytest_cache', '.ruff_cache', '.tox', '.idea', '.vscode', 'site-packages', 'dist', 'build'}
+INDEX_BYTES = 512 * 1024      # 每个文件只索引前 512KB，更大的文件只确认不加速
+MAX_BITS = 1 << 16
+MAGIC = b'GASIDX3\n'
+RECORD = struct.Struct('<IqqI')    # 路径字节数, mtime_ns, size, 位数 m；其后为路径和 m//8 字节位图
+
+def fold(data):
+    '''签名与查询共用的大小写折叠。用 str.casefold 而非 bytes.lower，使 re.IGNORECASE 下能互相匹配的非 ASCII 字符
+    （Ä/ä、K/k、ſ/s 等）折叠到同一字节序列；无法解码的字节原样保留'''
+    return data.decode('utf-8', 'surrogateescape').casefold().encode('utf-8', 'surrogateescape')
+
+def _trigram_hashes(data, m):
+    # 乘法哈希取高位（m 为 2 的幂，取低位会只依赖首字节）；须与 _signature 保持一致
+    shift = 33 - m.bit_length()
+    return {((a | b << 8 | c << 16) * 2654435761 & 0xFFFFFFFF) >> shift for a, b, c in zip(data, data[1:], data[2:])}
+
+def _signature(data):
+    data = fold(data)
+    if np is not None and len(data) > 2:
+        a = np.frombuffer(data, dtype=np.uint8).astype(np.uint64)
+        grams = np.unique(a[:-2] | a[1:-1] << 8 | a[2:] << 16)
+    else: grams = {a | b << 8 | c << 16 for a, b, c in zip(data, data[1:], data[2:])}
+    m = 1024
+    while m < len(grams) * 4 and m < MAX_BITS: m <<= 1
+    shift = 33 - m.bit_length()
+    if np is not None and len(data) > 2:
+        bits = np.zeros(m, dtype=bool); bits[((grams * 2654435761) & 0xFFFFFFFF) >> shift] = True
+        return m, int.from_bytes(np.packbits(bits, bitorder='little').tobytes(), 'little')
+    bits = bytearray(m // 8)
+    for h in {((x * 2654435761) & 0xFFFFFFFF) >> shift for x in grams}: bits[h >> 3] |= 1 << (h & 7)
+    return m, int.from_bytes(bits, 'little')
+
+def required_literals(pattern, regex):
+    '''查询中必然出现的字面片段（用于签名筛选）。正则只取顶层连续字面量，分支等无法确定时返回空'''
+    if not regex: return [pattern]
+    try: parsed = sre_parse.parse(pattern)
+    except re.error: return []
+    lits, cur = [], ''
+    for op, av in parsed:
+        if op is sre_parse.LITERAL: cur += chr(av); continue
+        if cur: lits.append(cur); cur = ''
+    if cur: lits.append(cur)
+    return [l for l in lits if len(l.encode('utf-8')) >= 3]
+
+def dump_files(files):
+    out = [MAGIC]
+    for p, (mt, size, m, bits) in files.items():
+        pb = p.encode('utf-8', 'surrogateescape')
+        out += [RECORD.pack(len(pb), mt, size, m), pb, bits.to_bytes(m // 8, 'little')]
+    return b''.join(out)
+
+def load_files(data):
+    '''dump_files 的逆过程；格式不符或截断时抛 ValueError'''
+    if not data.startswith(MAGIC): raise ValueError('not a search index')
+    files, pos = {}, len(MAGIC)
+    try:
+        while pos < len(data):
+            n, mt, size, m = RECORD.unpack_from(data, pos); pos += RECORD.size
+            p = data[pos:pos+n].decode('utf-8', 'surrogateescape'); pos += n
+            if m & (m - 1) or not 1024 <= m <= MAX_BITS or pos + m // 8 > len(data): raise ValueError('corrupt record')
+            files[p] = (mt, size, m, int.from_bytes(data[pos:pos + m // 8], 'little')); pos += m // 8
+    except struct.error as e: raise ValueError(str(e))
+    return files
+
+def default_store_path(cwd):
+    '''按工作目录区分的索引文件，放在用户缓存目录而不是 agent 自己可写的工作目录中'''
+    base = os.environ.get('LOCALAPPDATA') if os.name == 'nt' else os.environ.get('XDG_CACHE_HOME')
+    base = os.path.join(base or os.path.join(os.path.expanduser('~'), '.cache'), 'generic_agent')
+    return os.path.join(base, f"search_{hashlib.sha1(os.path.abspath(cwd).encode('utf-8')).hexdigest()[:16]}.idx")
+
+class SearchIndex:
+    def __init__(self, store_path=None, refresh_interval=30, save_delay=10):
+        self.store_path, self.refresh_interval, self.save_delay = store_path, refresh_interval, save_delay
+        self.files = {}          # path -> (mtime_ns, size, m, bits)
+        self.roots, self.last_walk = set(), {}
+        self.dirs = {}           # 遍历过的目录 -> mtime_ns，目录下有文件增删时 mtime 会变
+        self.lock = threading.RLock()
+        self.dirty, self.save_timer = False, None
+        if store_path and os.path.exists(store_path):
+            try:
+                with open(store_path, 'rb') as f: self.files = load_files(f.read())
+            except (OSError, ValueError) as e: print(f"[Warn] search index load failed: {e}")
+
+    def save(self):
+        if not self.store_path: return
+        with self.lock:
+            self.save_timer = None
+            if not self.dirty: return
+            data, self.dirty = dump_files(self.files), False
+        try:
+            os.makedirs(os.path.dirname(self.store_path), exist_ok=True)
+            tmp = self.store_path + '.tmp'
+            with open(tmp, 'wb') as f: f.write(data)
+            os.replace(tmp, self.store_path)
+        except OSError as e:
+            print(f"[Warn] search index save failed: {e}")
+            with self.lock: self.dirty = True
+
+    def schedule_save(self):
+        '''有改动时延迟 save_delay 秒保存一次，期间的多次查询合并为一次写盘'''
+        with self.lock:
+            if not self.store_path or not self.dirty or self.save_timer is not None: return
+            self.save_timer = threading.Timer(self.save_delay, self.save); self.save_timer.daemon = True
+            self.save_timer.start()
+
+    def update_file(self, path, st=None):
+        '''(重新)索引单个文件；文件已删除或为二进制时移除'''
+        path = os.path.abspath(path)
+        with self.lock:
+            try:
+                st = st or os.stat(path)
+                old = self.files.get(path)
+                if old and old[:2] == (st.st_mtime_ns, st.st_size): return
+                with open(path, 'rb') as f: data = f.read(INDEX_BYTES)
+                if b'\0' in data[:8192]: raise ValueError('binary')
+                self.files[path] = (st.st_mtime_ns, st.st_size) + _signature(data)
+            except (OSError, ValueError): self.files.pop(path, None)
+            self.dirty = True
+
+    def refresh(self, root, force=False):
+        '''遍历 root，增量索引变化的文件、移除已删除的文件；返回本次是否实际遍历'''
+        root = os.path.abspath(root)
+        if not force and time.time() - self.last_walk.get(root, 0) < self.refresh_interval and not self._stale(root): return False
+        seen, dirs = set(), {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS and not d.startswith('.')]
+            try: dirs[dirpath] = os.stat(dirpath).st_mtime_ns
+            except OSError: pass
+            for fn in filenames:
+                p = os.path.join(dirpath, fn); seen.add(p)
+                try: st = os.stat(p)
+                except OSError: continue
+                old = self.files.get(p)
+                if not old or old[:2] != (st.st_mtime_ns, st.st_size): self.update_file(p, st)
+        with self.lock:
+            prefix = os.path.join(root, '')
+            for p in [p for p in self.files if p.startswith(prefix) and p not in seen]: del self.files[p]; self.dirty = True
+            for d in [d for d in self.dirs if d == root or d.startswith(prefix)]: del self.dirs[d]
+            self.dirs.update(dirs)
+        self.roots.add(root); self.last_walk[root] = time.time()
+        return True
+
+    def _stale(self, root):
+        '''节流期间的廉价复核：重新索引 mtime/size 变化的已索引文件；有目录增删文件时返回 True 以触发完整遍历'''
+        prefix = os.path.join(root, '')
+        with self.lock:
+            dirs = [(d, mt) for d, mt in self.dirs.items() if d == root or d.startswith(prefix)]
+            files = [(p, v[:2]) for p, v in self.files.items() if p.startswith(prefix)]
+        if not dirs: return True
+        for d, mt in dirs:
+            try:
+                if os.stat(d).st_mtime_ns != mt: return True
+            except OSError: return True
+        for p, key in files:
+            try: st = os.stat(p)
+            except OSError: return True
+            if (st.st_mtime_ns, st.st_size) != key: self.update_file(p, st)
+        return False
+
+    def candidates(self, roots, literals, name=None):
+        '''签名包含全部字面片段三元组的文件；文件名包含 name 的文件总是候选'''
+        prefixes = tuple(os.path.join(os.path.abspath(r), '') for r in roots)
+        grams = [fold(l.encode('utf-8')) for l in literals]   # 与索引一致的折叠
+        masks = {}
+        with self.lock: items = list(self.files.items())
+        for p, (mt, size, m, bits) in items:
+            if not p.startswith(prefixes): continue
+            if grams and size <= INDEX_BYTES:
+                mask = masks.get(m)
+                if mask is None:
+                    mask = 0
+                    for g in grams:
+                        for h in _trigram_hashes(g, m): mask |= 1 << h
+                    masks[m] = mask
+                if bits & mask != mask and not (name and name in os.path.basename(p).lower()): continue
+            yield p, mt
+
+    def _confirm(self, roots, rx, literals, qname, per_file, max_scan):
+        cands = list(self.candidates(roots, literals, qname))
+        # 文件名命中的优先确认，其余按最近修改排序
+        cands.sort(key=lambda x: (not (qname and qname in os.path.basename(x[0]).lower()), -x[1]))
+        results = []
+        for p, mt in cands[:max_scan]:
+            try:
+                with open(p, 'r', encoding='utf-8', errors='replace') as f: text = f.read()
+            except OSError: continue
+            hits, line, last = [], 1, 0
+            for m in rx.finditer(text):
+                line += text.count('\n', last, m.start()); last = m.start()
+                if hits and hits[-1][0] == line: continue
+                ls, le = text.rfind('\n', 0, m.start()) + 1, text.find('\n', m.start())
+                hits.append((line, text[ls:le if le >= 0 else len(text)].strip()[:200]))
+                if len(hits) > per_file * 4: break
+            name_hit = bool(qname and qname in os.path.basename(p).lower())
+            if hits or name_hit: results.append((name_hit * 100 + min(len(hits), 20), mt, p, hits))
+        return cands, results
+
+    def search(self, roots, query, regex=False, case_sensitive=False, max_results=30, per_file=5, max_scan=3000):
+        t0 = time.time()
+        for r in roots: self.refresh(r)
+        rx = re.compile(query if regex else re.escape(query), re.MULTILINE | (0 if case_sensitive else re.IGNORECASE))
+        qname = query.lower() if not regex else None
+        literals = required_literals(query, regex)
+        cands, results = self._confirm(roots, rx, literals, qname, per_file, max_scan)
+        results.sort(key=lambda x: (-x[0], -x[1]))
+        self.schedule_save()
+        return {"files_indexed": len(self.files), "candidates": len(cands), "matched_files": len(results),
+                "elapsed_ms": round((time.time() - t0) * 1000, 1), "results": results, "max_results": max_results, "per_file": per_file}
+
+def format_results(res, query, base=None):
+    out, n = [], 0
+    for score, mt, p, hits in res["results"]:
+        if n >= res["max_results"]: break
+        rel = os.path.relpath(p, base) if base else p
+        out.append(rel + (f"  ({len(hits)}+ hits)" if len(hits) > res["per_file"] else ""))
+        for ln, txt in hits[:res["per_file"]]:
+            if n >= res["max_results"]: break
+            out.append(f"  {ln}|{txt}"); n += 1
+        if not hits: n += 1
+    head = f"[search] '{query}': {res['matched_files']} files matched ({res['candidates']} candidates / {res['files_indexed']} indexed, {res['elapsed_ms']}ms)"
+    if len(res["results"]) and n >= res["max_results"]: out.append(f"... 结果已截断为 {res['max_results']} 条，请使用更具体的关键字或 path 缩小范围")
+    return head + ("\n" + "\n".join(out) if out else "\n无匹配")
+
+_indexes = {}
+atexit.register(lambda: [idx.save() for idx in list(_indexes.values())])
+
+def get_index(store_path):
+    if store_path not in _indexes: _indexes[store_path] = SearchIndex(store_path)
+    return _indexes[store_path]
@@ -1,21 +1,23 @@
 import sys, os, re, json, time, threading
 from pathlib import Path
-import tempfile, traceback, subprocess, itertools, collections
+import io, mmap, signal, bisect, hashlib, shutil, tempfile, traceback, subprocess, itertools, collections
 if sys.stdout is None: sys.stdout = open(os.devnull, "w")
 if sys.stderr is None: sys.stderr = open(os.devnull, "w")
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from agent_loop import BaseHandler, StepOutcome, try_call_generator
+from agent_loop import BaseHandler, StepOutcome, try_call_generator, fair_share, budget_json
 
-def code_run(code, code_type="python", timeout=60, cwd=None, code_cwd=None, stop_signal=[]):
-    """代码执行器
-    python: 运行复杂的 .py 脚本（文件模式）
-    powershell/bash: 运行单行指令（命令模式）
-    优先使用python，仅在必要系统操作时使用powershell。
-    """
-    preview = (code[:60].replace('\n', ' ') + '...') if len(code) > 60 else code.strip()
-    yield f"[Action] Running {code_type} in {os.path.basename(cwd)}: {preview}\n"
-    cwd = cwd or os.path.join(os.getcwd(), 'temp'); tmp_path = None
+class StopSignal(list):
+    '''code_run 的停止信号，兼容 list 接口；append 时立刻唤醒正在等待的进程'''
+    def __init__(self):
+        super().__init__(); self.waiters = set()
+    def append(self, x):
+        super().append(x)
+        for w in list(self.waiters): w.set()
+
+def make_code_cmd(code, code_type, code_cwd=None):
+    '''返回 (cmd, tmp_path)；python 代码写入临时 .ai.py 文件，由调用方负责删除'''
+    tmp_path = None
     if code_type == "python":
         tmp_file = tempfile.NamedTemporaryFile(suffix=".ai.py", delete=False, mode='w', encoding='utf-8', dir=code_cwd)
         tmp_file.write(code)
@@ -25,57 +27,201 @@ def code_run(code, code_type="python", timeout=60, cwd=None, code_cwd=None, stop
     elif code_type in ["powershell", "bash"]:
         if os.name == 'nt': cmd = ["powershell", "-NoProfile", "-NonInteractive", "-Command", code]
         else: cmd = ["bash", "-c", code]
-    else:
-        return {"status": "error", "msg": f"不支持的类型: {code_type}"}
-    print("code run output:") 
-    startupinfo = None
+    else: raise ValueError(f"不支持的类型: {code_type}")
+    return cmd, tmp_path
+
+def popen_hidden(cmd, cwd, new_group=False):
+    '''new_group: 子进程自成进程组（POSIX 新会话 / Windows 新进程组），以便 kill_tree 连同其子孙进程一起结束'''
+    startupinfo, kw = None, {}
     if os.name == 'nt':
         startupinfo = subprocess.STARTUPINFO()
         startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
         startupinfo.wShowWindow = 0 # SW_HIDE
-    full_stdout = []
+        if new_group: kw['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+    elif new_group: kw['start_new_session'] = True
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            bufsize=0, cwd=cwd, startupinfo=startupinfo, **kw)
+
+def kill_tree(proc):
+    '''结束 popen_hidden(new_group=True) 启动的进程及其子孙，否则孙进程继承输出管道，读线程会一直阻塞'''
+    try:
+        if os.name == 'nt':
+            subprocess.run(["taskkill", "/T", "/F", "/PID", str(proc.pid)], capture_output=True, timeout=10)
+        else: os.killpg(proc.pid, signal.SIGKILL)
+    except (OSError, subprocess.SubprocessError): pass
+    try: proc.kill()
+    except OSError: pass
+
+def decode_line(line_bytes):
+    try: return line_bytes.decode('utf-8')
+    except UnicodeDecodeError: return line_bytes.decode('gbk', errors='ignore')
+
+def read_lines(stream, limit=1<<16):
+    '''按行读取字节流；无换行的超长输出按 limit 切块，避免单行占满内存'''
+    carry = b''
+    for chunk in iter(lambda: stream.readline(limit), b''):
+        chunk, carry = carry + chunk, b''
+        if not chunk.endswith(b'\n'):
+            try: chunk.decode('utf-8')
+            except UnicodeDecodeError as e:   # 切块落在多字节字符中间，留到下一块
+                if e.start >= len(chunk) - 3: chunk, carry = chunk[:e.start], chunk[e.start:]
+        if chunk: yield decode_line(chunk)
+    if carry: yield decode_line(carry)
+
+class OutputCapture:
+    '''有界输出缓冲：内存只保留开头 head_max 与结尾 tail_max 字符，
+    中间被挤出的部分连同首尾一起按顺序写入 spill_dir 下的溢出文件，内存占用与输出总量无关。
+    '''
+    def __init__(self, spill_dir=None, head_max=4000, tail_max=4000, prefix='code_run'):
+        self.head_max, self.tail_max, self.prefix = head_max, tail_max, prefix
+        self.spill_dir = spill_dir or tempfile.gettempdir()
+        self.head, self.head_len = [], 0
+        self.tail, self.tail_len = collections.deque(), 0
+        self.n_lines, self.n_chars, self.dropped = 0, 0, 0
+        self.spill, self.spill_path = None, None
+        self.lock = threading.Lock()
+
+    def append(self, line):
+        with self.lock:
+            self.n_lines += 1; self.n_chars += len(line)
+            if not self.tail and self.head_len < self.head_max:
+                self.head.append(line); self.head_len += len(line); return
+            self.tail.append(line); self.tail_len += len(line)
+            while self.tail_len > self.tail_max and len(self.tail) > 1:
+                old = self.tail.popleft(); self.tail_len -= len(old); self.dropped += 1
+                self._spill(old)
+
+    def _spill(self, text):
+        if self.spill is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            fd, self.spill_path = tempfile.mkstemp(prefix=f"{self.prefix}_{time.strftime('%m%d_%H%M%S')}_", suffix='.log', dir=self.spill_dir)
+            self.spill = open(fd, 'w', encoding='utf-8', errors='replace')
+            self.spill.write("".join(self.head))
+        self.spill.write(text)
+
+    def close(self):
+        '''输出结束后把内存中的结尾也写入溢出文件，使其成为完整输出'''
+        with self.lock:
+            if self.spill is None: return
+            self.spill.write("".join(self.tail)); self.spill.close(); self.spill = False
+
+    def _omit_note(self):
+        if not self.spill_path: return '\n[omitted long output]\n'
+        return f"\n[omitted {self.dropped} lines, full output: {self.spill_path} ，可用 file_read 配合 keyword 查看]\n"
+
+    def text(self):
+        with self.lock:
+            head, tail = "".join(self.head)[:self.head_max], "".join(self.tail)[-self.tail_max:]
+            mid = self._omit_note() if self.dropped or self.n_chars > len(head) + len(tail) else ""
+            return head + mid + tail
+
+    def since(self, pos):
+        '''返回第 pos 行之后仍在内存中的输出及新的位置；中间被挤出的部分给出提示'''
+        with self.lock:
+            out = "".join(self.head[pos:])
+            tail_start = self.n_lines - len(self.tail)
+            if max(pos, len(self.head)) < tail_start: out += self._omit_note()
+            out += "".join(itertools.islice(self.tail, max(0, pos - tail_start), None))
+            return out, self.n_lines
+
+    def last(self, n):
+        with self.lock:
+            lines = list(self.tail)[-n:] if n > 0 else []
+            if len(lines) < n and not self.dropped: lines = self.head[len(lines)-n:] + lines
+            return "".join(lines)
+
+def code_run(code, code_type="python", timeout=60, cwd=None, code_cwd=None, stop_signal=[], worker=None,
+             stream_interval=0.5, stream_max=2000, timing=None):
+    """代码执行器
+    python: 运行复杂的 .py 脚本（文件模式）
+    powershell/bash: 运行单行指令（命令模式）
+    优先使用python，仅在必要系统操作时使用powershell。
+    worker: 可选的常驻进程（python 用 PyWorker/PyWorkerPool，shell 用 ShellSession），不可用时退回一次性子进程。
+    运行中的输出每 stream_interval 秒最多 yield 一次（每次至多 stream_max 字符），供 UI 实时显示。
+    timing: 可选 dict，填入 first_output（首个输出行耗时）与 duration，单位秒。
+    """
+    preview = (code[:60].replace('\n', ' ') + '...') if len(code) > 60 else code.strip()
+    yield f"[Action] Running {code_type} in {os.path.basename(cwd)}: {preview}\n"
+    cwd = cwd or os.path.join(os.getcwd(), 'temp')
+    try: cmd, tmp_path = make_code_cmd(code, code_type, code_cwd)
+    except ValueError as e: return {"status": "error", "msg": str(e)}
+    print("code run output:") 
+    full_stdout = OutputCapture(os.path.abspath(code_cwd or cwd), head_max=4000, tail_max=4000)
 
     def stream_reader(proc, logs):
-        for line_bytes in iter(proc.stdout.readline, b''):
-            try: line = line_bytes.decode('utf-8')
-            except UnicodeDecodeError: line = line_bytes.decode('gbk', errors='ignore')
+        for line in read_lines(proc.stdout):
             logs.append(line)
+            if first_out[0] is None: first_out[0] = time.time()
+            wake.set()
             print(line, end="") 
 
+    def take_new():
+        new, pos[0] = full_stdout.since(pos[0])
+        if len(new) > stream_max: new = new[:stream_max//2] + '\n[omitted long output]\n' + new[-stream_max//2:]
+        return new
+
     try:
-        process = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-            bufsize=0, cwd=cwd, startupinfo=startupinfo
-        )
+        process = None
+        if worker is not None:
+            try: process = worker.submit(tmp_path or code, cwd)
+            except Exception as e: print(f"[Warn] pyworker unavailable, fallback to one-shot: {e}")
+        if process is None: process = popen_hidden(cmd, cwd)
         start_t = time.time()
-        t = threading.Thread(target=stream_reader, args=(process, full_stdout), daemon=True)
+        wake, pos, first_out, last_emit = threading.Event(), [0], [None], 0
+        def watch(fn):
+            try: fn()
+            finally: wake.set()
+        t = threading.Thread(target=watch, args=(lambda: stream_reader(process, full_stdout),), daemon=True)
         t.start()
+        threading.Thread(target=watch, args=(process.wait,), daemon=True).start()
+        yield "[Stdout]\n"
+        waiters = getattr(stop_signal, 'waiters', None)
+        if waiters is not None: waiters.add(wake)
+        try:
+            while t.is_alive() and process.poll() is None:
+                remain = timeout - (time.time() - start_t)
+                if remain <= 0 or len(stop_signal) > 0:
+                    process.kill()
+                    print("[Debug] Process killed due to timeout or stop signal.")
+                    if remain <= 0: full_stdout.append("\n[Timeout Error] 超时强制终止")
+                    else: full_stdout.append("\n[Stopped] 用户强制终止")
+                    break
+                wait_t = remain if waiters is not None else min(remain, 0.2)
+                if full_stdout.n_lines > pos[0]:   # 有新输出：按 stream_interval 限速推送给UI
+                    now = time.time()
+                    if now - last_emit >= stream_interval:
+                        new = take_new(); last_emit = now
+                        if new: yield new
+                    else: wait_t = min(wait_t, last_emit + stream_interval - now)
+                # 进程退出/新输出/停止信号都会唤醒；普通list形式的stop_signal退化为短间隔检查
+                wake.wait(max(wait_t, 0))
+                wake.clear()
+        finally:
+            if waiters is not None: waiters.discard(wake)
 
-        while t.is_alive():
-            istimeout = time.time() - start_t > timeout
-            if istimeout or len(stop_signal) > 0:
-                process.kill()
-                print("[Debug] Process killed due to timeout or stop signal.")
-                if istimeout: full_stdout.append("\n[Timeout Error] 超时强制终止")
-                else: full_stdout.append("\n[Stopped] 用户强制终止")
-                break
-            time.sleep(1)
-
-        t.join(timeout=1)
-        exit_code = process.poll()
+        t.join(timeout=0.2)   # 进程已退出时只需等待管道中剩余输出
+        try: exit_code = process.wait(timeout=1)
+        except subprocess.TimeoutExpired: exit_code = None
 
-        stdout_str = "".join(full_stdout)
+        full_stdout.close()
+        stdout_str = full_stdout.text()
         status = "success" if exit_code == 0 else "error"
         status_icon = "✅" if exit_code == 0 else "❌"
         if exit_code is None: status_icon = "⏳" 
-        output_snippet = smart_format(stdout_str, max_str_len=600, omit_str='\n[omitted long output]\n')
-        yield f"[Status] {status_icon} Exit Code: {exit_code}\n[Stdout]\n{output_snippet}\n"
+        rest = take_new()
+        if rest: yield rest
+        if timing is not None:
+            timing["duration"] = round(time.time() - start_t, 3)
+            timing["first_output"] = round(first_out[0] - start_t, 3) if first_out[0] else None
+        yield f"\n[Status] {status_icon} Exit Code: {exit_code}\n"
         if process.stdout: threading.Thread(target=process.stdout.close, daemon=True).start()
-        return {
+        result = {
             "status": status,
-            "stdout": smart_format(stdout_str, max_str_len=8000, omit_str='\n[omitted long output]\n'),
+            "stdout": stdout_str if full_stdout.spill_path else smart_format(stdout_str, max_str_len=8000, omit_str='\n[omitted long output]\n'),
             "exit_code": exit_code
         }
+        if full_stdout.spill_path: result["spill_path"] = full_stdout.spill_path
+        return result
     except Exception as e:
         if 'process' in locals(): process.kill()
         return {"status": "error", "msg": str(e)}
@@ -83,6 +229,62 @@ def code_run(code, code_type="python", timeout=60, cwd=None, code_cwd=None, stop
         if code_type == "python" and tmp_path and os.path.exists(tmp_path): os.remove(tmp_path)
 
 
+class BgJob:
+    '''后台 code_run 作业：立即返回，输出在后台收集，可通过 code_job 工具查询/追踪/取消'''
+    def __init__(self, job_id, code, code_type, cwd, code_cwd=None, timeout=None):
+        self.id, self.code_type, self.timeout = job_id, code_type, timeout
+        self.preview = (code[:60].replace('\n', ' ') + '...') if len(code) > 60 else code.strip()
+        self.cmd, self.tmp_path = make_code_cmd(code, code_type, code_cwd)
+        self.out, self.read_pos, self.note = OutputCapture(os.path.abspath(code_cwd or cwd), prefix=job_id), 0, ""
+        self.start_t, self.end_t = time.time(), None
+        try: self.proc = popen_hidden(self.cmd, cwd, new_group=True)
+        except Exception:
+            self._cleanup(); raise
+        threading.Thread(target=self._reader, daemon=True).start()
+        if timeout: threading.Thread(target=self._watchdog, daemon=True).start()
+
+    def _reader(self):
+        try:
+            for line in read_lines(self.proc.stdout): self.out.append(line)
+        except (OSError, ValueError): pass
+        self.proc.wait(); self.end_t = time.time()
+        self.out.close()
+        self._cleanup()
+
+    def _watchdog(self):
+        try: self.proc.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            self.note = "[Timeout Error] 超时强制终止"; kill_tree(self.proc)
+
+    def _cleanup(self):
+        if self.tmp_path and os.path.exists(self.tmp_path):
+            try: os.remove(self.tmp_path)
+            except OSError: pass
+
+    def running(self): return self.proc.poll() is None
+
+    def info(self):
+        exit_code = self.proc.poll()
+        return {"job_id": self.id, "type": self.code_type, "code": self.preview,
+                "status": "running" if exit_code is None else ("success" if exit_code == 0 else "error"),
+                "exit_code": exit_code, "elapsed": round((self.end_t or time.time()) - self.start_t, 1),
+                "output_lines": self.out.n_lines, **({"spill_path": self.out.spill_path} if self.out.spill_path else {}),
+                **({"note": self.note} if self.note else {})}
+
+    def poll(self):
+        '''返回状态及上次 poll 以来的新输出'''
+        new, self.read_pos = self.out.since(self.read_pos)
+        return dict(self.info(), new_output=new)
+
+    def tail(self, n=50):
+        return dict(self.info(), tail=self.out.last(n))
+
+    def cancel(self):
+        if self.running() or self.end_t is None:     # 主进程已退出但孙进程仍占着输出管道时也要清理
+            self.note = "[Stopped] 已取消"; kill_tree(self.proc)
+        return self.info()
+
+
 def ask_user(question: str, candidates: list = None):
     """question: 向用户提出的问题。candidates: 可选的候选项列表。需要保证should_exit为True
     """
@@ -174,73 +376,394 @@ def web_execute_js(script: str):
     except Exception as e:
         return {"status": "error", "msg": format_error(e)}
     
+NOT_FOUND_MSG = "未找到匹配的旧文本块，建议：先用 file_read 确认当前内容，再分小段进行 patch。若多次失败则询问用户，严禁自行使用 overwrite 或代码替换。"
+AMBIGUOUS_MSG = "找到 {count} 处匹配，无法确定唯一位置。请提供更长、更具体的旧文本块以确保唯一性。建议：包含上下文行来增强特征，或分小段逐个修改。"
+
 def file_patch(path: str, old_content: str, new_content: str):
     """在文件中寻找唯一的 old_content 块并替换为 new_content。
     """
-    path = str(Path(path).resolve())
+    ok, report = file_patch_hunks([(path, old_content, new_content)])
+    if ok: return {"status": "success", "msg": "文件局部修改成功"}
+    return {"status": "error", "msg": report[0]["msg"]}
+
+def _copy_bytes(src, dst, n, bufsize=1 << 20):
+    while n > 0:
+        buf = src.read(min(bufsize, n))
+        if not buf: break
+        dst.write(buf); n -= len(buf)
+
+def stage_file(path, write_fn):
+    '''在目标同目录写临时文件(write_fn(dst))并 fsync，返回临时文件路径，供 commit_files 原子替换'''
+    d = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=d)
+    try:
+        with open(fd, 'wb') as dst:
+            write_fn(dst); dst.flush(); os.fsync(dst.fileno())
+        if os.path.exists(path): shutil.copymode(path, tmp)
+        return tmp
+    except BaseException:
+        os.remove(tmp); raise
+
+def commit_files(staged):
+    '''用 os.replace 依次替换 [(path, tmp)]；多文件时先做硬链接备份，中途失败则回滚已替换的文件'''
+    backups, done = {}, []
+    try:
+        if len(staged) > 1:
+            for path, tmp in staged:
+                if not os.path.exists(path): continue
+                try: os.link(path, tmp + ".bak"); backups[path] = tmp + ".bak"
+                except OSError: pass    # 不支持硬链接时退化为尽力而为
+        for path, tmp in staged:
+            os.replace(tmp, path); done.append(path)
+    except BaseException:
+        for path in done:
+            if path in backups: os.replace(backups.pop(path), path)
+        for _, tmp in staged:
+            if os.path.exists(tmp): os.remove(tmp)
+        raise
+    finally:
+        for bak in backups.values():
+            if os.path.exists(bak): os.remove(bak)
+
+def write_file_safe(path, content, mode="overwrite"):
+    '''写入文本并返回实际写入的字节数。overwrite/prepend 写临时文件后原子替换，prepend 流式拷贝原文件不整体读入；
+    append 原地追加并 fsync，失败时截断回原长度，原有内容不受影响。
+    '''
+    data = content.replace('\n', os.linesep).encode('utf-8') if os.linesep != '\n' else content.encode('utf-8')
+    if mode == "append":
+        with open(path, 'ab') as f:
+            size = f.tell()
+            try: f.write(data); f.flush(); os.fsync(f.fileno())
+            except BaseException:
+                f.truncate(size); raise
+        return len(data)
+    def write(dst):
+        dst.write(data)
+        if mode == "prepend" and os.path.exists(path):
+            with open(path, 'rb') as src: shutil.copyfileobj(src, dst, 1 << 20)
+    commit_files([(path, stage_file(path, write))])
+    return len(data)
+
+def file_patch_hunks(hunks):
+    '''把多个 (path, old_content, new_content) 作为一个事务应用：每块必须在原文件中唯一匹配且互不重叠，
+    全部匹配成功才写入。按字节在 mmap 上查找，流式拷贝未改动部分到临时文件后原子替换，不整体读入内存。
+    文件为 CRLF 换行而 old_content 为 LF 时自动按 CRLF 匹配。返回 (ok, 每块的报告)。
+    '''
+    report, plans = [None] * len(hunks), collections.OrderedDict()
+    for i, (path, old, new) in enumerate(hunks):
+        plans.setdefault(str(Path(path).resolve()), []).append((i, old, new))
+    for path, items in plans.items():
+        spans = []
+        if not os.path.exists(path):
+            for i, _, _ in items: report[i] = {"hunk": i+1, "path": path, "status": "error", "msg": "文件不存在"}
+            continue
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            try:
+                crlf = mm.find(b'\r\n') >= 0
+                for i, old, new in items:
+                    ob, nb = old.encode('utf-8'), new.encode('utf-8')
+                    pos = mm.find(ob) if ob else -1
+                    if pos < 0 and crlf and b'\n' in ob and b'\r\n' not in ob:
+                        ob, nb = ob.replace(b'\n', b'\r\n'), nb.replace(b'\n', b'\r\n')
+                        pos = mm.find(ob)
+                    if pos < 0:
+                        report[i] = {"hunk": i+1, "path": path, "status": "not_found", "msg": NOT_FOUND_MSG}; continue
+                    count, nxt = 1, mm.find(ob, pos + len(ob))
+                    while nxt >= 0 and count < 100: count += 1; nxt = mm.find(ob, nxt + len(ob))
+                    if count > 1:
+                        report[i] = {"hunk": i+1, "path": path, "status": "ambiguous", "msg": AMBIGUOUS_MSG.format(count=count)}; continue
+                    line = get_line_index(path).line_at(pos, mm)
+                    report[i] = {"hunk": i+1, "path": path, "status": "ok", "line": line}
+                    spans.append((pos, pos + len(ob), nb, i))
+            finally:
+                if size: mm.close()
+        spans.sort()
+        for a, b in zip(spans, spans[1:]):
+            if b[0] < a[1]:
+                report[b[3]] = dict(report[b[3]], status="overlap", msg=f"与第 {a[3]+1} 块修改区域重叠，请合并为一块")
+        plans[path] = spans
+    if any(r["status"] != "ok" for r in report): return False, report
+    staged = []
     try:
-        if not os.path.exists(path): return {"status": "error", "msg": "文件不存在"}
-        with open(path, 'r', encoding='utf-8') as f: full_text = f.read()
-        # 检查唯一性
-        count = full_text.count(old_content)
-        if count == 0: return {"status": "error", "msg": "未找到匹配的旧文本块，建议：先用 file_read 确认当前内容，再分小段进行 patch。若多次失败则询问用户，严禁自行使用 overwrite 或代码替换。"}
-        if count > 1: return {"status": "error", "msg": f"找到 {count} 处匹配，无法确定唯一位置。请提供更长、更具体的旧文本块以确保唯一性。建议：包含上下文行来增强特征，或分小段逐个修改。"}
-        updated_text = full_text.replace(old_content, new_content)
-        with open(path, 'w', encoding='utf-8') as f: f.write(updated_text)
-        return {"status": "success", "msg": "文件局部修改成功"}
+        for path, spans in plans.items():
+            def write(dst, path=path, spans=spans):
+                with open(path, 'rb') as src:
+                    cur = 0
+                    for s, e, nb, _ in spans:
+                        _copy_bytes(src, dst, s - cur); dst.write(nb); src.seek(e); cur = e
+                    shutil.copyfileobj(src, dst, 1 << 20)
+            staged.append((path, stage_file(path, write)))
+        commit_files(staged)
     except Exception as e:
-        return {"status": "error", "msg": str(e)}
+        for _, tmp in staged:
+            if os.path.exists(tmp): os.remove(tmp)
+        for r in report: r.update(status="error", msg=f"写入失败，所有文件未修改: {e}")
+        return False, report
+    return True, report
+
+class LineIndex:
+    '''稀疏行偏移索引：每 STEP 行记录一次字节偏移，使 file_read 的任意 start 都变成一次 seek。
+    按需扫描到所需行为止；文件只是变长时（见 validate）在原索引上继续扫描，否则重建。
+    file_read_batch 和并发的 file_read 会在多个线程中共用同一索引，扫描与查询都在 self.lock 内进行。
+    '''
+    STEP = 1000
+    def __init__(self, path):
+        self.path = path
+        self.offsets = [0]           # offsets[k] = 第 k*STEP+1 行的起始字节
+        self.scanned = self.lines = 0   # 已扫描字节数 / 其中完整行数
+        self.size = self.mtime = None
+        self.digest = None           # 末个检查点到 scanned 之间内容的哈希，用于确认文件只是追加
+        self.lock = threading.Lock()
+
+    def _tail_digest(self, f):
+        f.seek(self.offsets[-1]); return hashlib.sha1(f.read(self.scanned - self.offsets[-1])).digest()
+
+    def validate(self, st):
+        '''大小和 mtime 未变时有效。文件变长时，若各检查点前一字节仍是换行、末个检查点之后已扫描的内容也未变，
+        视为追加，保留已有偏移并从 scanned 继续扫描；否则（含同长度改写）需要重建'''
+        with self.lock:
+            if (st.st_size, st.st_mtime_ns) == (self.size, self.mtime): return True
+            if self.size is None or st.st_size <= self.size: return False
+            if self.scanned:
+                with open(self.path, 'rb') as f:
+                    for off in self.offsets[1:]:
+                        f.seek(off - 1)
+                        if f.read(1) != b'\n': return False
+                    if self._tail_digest(f) != self.digest: return False
+            self.size, self.mtime = st.st_size, st.st_mtime_ns
+            return True
+
+    def seek_point(self, line):
+        '''返回 (行号, 字节偏移)，为不超过 line 的最近检查点'''
+        k = (line - 1) // self.STEP
+        with self.lock:
+            if k >= len(self.offsets) and self.scanned < self.size: self._scan(k)
+            k = min(k, len(self.offsets) - 1)
+            return k * self.STEP + 1, self.offsets[k]
+
+    def line_at(self, pos, buf):
+        '''字节偏移 pos 所在的行号；buf 为文件内容（如 mmap），用于统计检查点之后的换行数'''
+        with self.lock:
+            if pos >= self.scanned: self._scan(until=pos)
+            k = bisect.bisect_right(self.offsets, pos) - 1
+            base = self.offsets[k]
+        return k * self.STEP + 1 + buf[base:pos].count(b'\n')
+
+    def _scan(self, k=None, until=None):
+        with open(self.path, 'rb') as f:
+            f.seek(self.scanned)
+            while (until is not None and self.scanned <= until or k is not None and len(self.offsets) <= k) and self.scanned < self.size:
+                chunk = f.read(min(1 << 20, self.size - self.scanned))
+                if not chunk: break
+                n = chunk.count(b'\n')
+                if self.lines % self.STEP + n < self.STEP: self.lines += n   # 本块内没有检查点
+                else:
+                    i = 0
+                    while (j := chunk.find(b'\n', i)) >= 0:
+                        i = j + 1; self.lines += 1
+                        if self.lines % self.STEP == 0: self.offsets.append(self.scanned + i)
+                self.scanned += len(chunk)
+            self.digest = self._tail_digest(f)
 
-def file_read(path, start=1, keyword=None, count=200, show_linenos=True):
+_line_indexes, _line_indexes_lock = collections.OrderedDict(), threading.Lock()
+
+def get_line_index(path, max_cached=32):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    with _line_indexes_lock:
+        idx = _line_indexes.pop(path, None)
+        if idx is None or not idx.validate(st):
+            idx = LineIndex(path); idx.size, idx.mtime = st.st_size, st.st_mtime_ns
+        _line_indexes[path] = idx
+        while len(_line_indexes) > max_cached: _line_indexes.popitem(last=False)
+    return idx
+
+def file_search(path, pattern, start=1, regex=False, case_sensitive=False):
+    '''在内存映射的文件字节上搜索，按顺序产出 (行号, 行内容)。start 之前的行不搜索。
+    非 regex 模式按字面匹配；忽略大小写仅对 ASCII 字母生效。
+    '''
+    pat = pattern.encode('utf-8') if regex else re.escape(pattern.encode('utf-8'))
+    rx = re.compile(pat, re.MULTILINE | (0 if case_sensitive else re.IGNORECASE))
+    if os.path.getsize(path) == 0: return
+    idx = get_line_index(path)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        line, pos = idx.seek_point(start)
+        while line < start and (pos := mm.find(b'\n', pos) + 1) > 0: line += 1
+        if line < start: return
+        last_line = 0
+        for m in rx.finditer(mm, pos):
+            ln = idx.line_at(m.start(), mm)
+            if ln == last_line: continue   # 同一行只报告一次
+            last_line = ln
+            ls, le = mm.rfind(b'\n', 0, m.start()) + 1, mm.find(b'\n', m.start())
+            yield ln, mm[ls:le if le >= 0 else len(mm)].decode('utf-8', errors='replace').rstrip('\r')
+
+def file_read(path, start=1, keyword=None, count=200, show_linenos=True,
+              regex=False, case_sensitive=False, match_index=1, list_matches=False, max_matches=200):
     L_MAX = max(100, 1024000//count); TAG = " ... [TRUNCATED]"
     try:
-        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        if keyword:
+            hits = file_search(path, keyword, start, regex=regex, case_sensitive=case_sensitive)
+            if list_matches:
+                found = list(itertools.islice(hits, max_matches + 1))
+                if not found: return f"Keyword '{keyword}' not found after line {start}."
+                more = f"\n... (超过 {max_matches} 处匹配，仅列出前 {max_matches} 处，可增大 start 继续)" if len(found) > max_matches else ""
+                lines = [f"{i}|{l[:200] + TAG if len(l) > 200 else l}" for i, l in found[:max_matches]]
+                return f"Matches for '{keyword}' ({len(lines)}):\n" + "\n".join(lines) + more
+            hit = next(itertools.islice(hits, max(1, match_index) - 1, None), None)
+            if hit is None: return f"Keyword '{keyword}' {f'match #{match_index} ' if match_index > 1 else ''}not found after line {start}."
+            start = max(hit[0] - count//3, start, 1)
+        first, offset = 1, 0
+        if start > LineIndex.STEP: first, offset = get_line_index(path).seek_point(start)
+        with open(path, 'rb') as raw:
+            raw.seek(offset)
+            f = io.TextIOWrapper(raw, encoding='utf-8', errors='replace', newline='\n')   # 与索引一致，只按 \n 分行
             stream = (
                 (i, (l[:L_MAX].rstrip() + TAG if len(l) > L_MAX else l.rstrip('\r\n')))
-                for i, l in enumerate(f, 1)
+                for i, l in enumerate(f, first)
             )
             stream = itertools.dropwhile(lambda x: x[0] < start, stream)
-            if keyword:
-                before = collections.deque(maxlen=count//3)
-                for i, l in stream:
-                    if keyword.lower() in l.lower():
-                        res = list(before) + [(i, l)] + list(itertools.islice(stream, count - len(before) - 1))
-                        break
-                    before.append((i, l))
-                else: return f"Keyword '{keyword}' not found after line {start}."
-            else: res = itertools.islice(stream, count)
+            res = itertools.islice(stream, count)
             return "\n".join(f"{i}|{l}" if show_linenos else l for i, l in res)
     except Exception as e:
         return f"Error: {str(e)}"
 
-def smart_format(data, max_depth=2, max_str_len=100, omit_str=' ... '):
-    def truncate(obj, depth):
-        if isinstance(obj, str):
-            if len(obj) < max_str_len+len(omit_str)*2: return obj
-            return f"{obj[:max_str_len//2]}{omit_str}{obj[-max_str_len//2:]}"
-        if depth >= max_depth: return truncate(str(obj), depth + 1)
-        if isinstance(obj, dict): return {k: truncate(v, depth + 1) for k, v in obj.items()}
-        if isinstance(obj, list): return [truncate(i, depth + 1) for i in obj]
-        return obj
-    if isinstance(data, (str, bytes)): return truncate(data, 0)
-    return json.dumps(truncate(data, 0), indent=2, ensure_ascii=False, default=str)
+def file_read_batch(specs, cwd='./', budget=20000, max_files=30, workers=8):
+    '''并发读取多个文件（支持 glob），返回 [(path, text)]，总字符数不超过 budget 且在文件间公平分配。
+    specs: [{"path": 路径或glob, "start", "count", "keyword"}]
+    '''
+    import glob
+    from concurrent.futures import ThreadPoolExecutor
+    jobs = []
+    for spec in specs:
+        if isinstance(spec, str): spec = {"path": spec}
+        pat = os.path.join(cwd, spec.get("path", ""))
+        paths = sorted(glob.glob(pat, recursive=True)) if glob.has_magic(pat) else [pat]
+        jobs += [(os.path.abspath(p), spec) for p in paths if not os.path.isdir(p)]
+    skipped = max(0, len(jobs) - max_files); jobs = jobs[:max_files]
+    def read(job):
+        p, spec = job
+        return file_read(p, start=spec.get("start", 1), keyword=spec.get("keyword"), count=spec.get("count", 100))
+    with ThreadPoolExecutor(max_workers=workers) as pool: texts = list(pool.map(read, jobs))
+    results = []
+    for (p, _), text, limit in zip(jobs, texts, fair_share([len(t) for t in texts], budget)):
+        if len(text) > limit:
+            cut = text.rfind("\n", 0, limit)
+            text = text[:cut if cut > 0 else limit]
+            m = re.match(r"(\d+)\|", text[text.rfind("\n")+1:])
+            text += f"\n[TRUNCATED: 预算不足" + (f"，从 start={int(m.group(1))+1} 继续读取]" if m else "]")
+        results.append((p, text))
+    if skipped: results.append(("", f"[另有 {skipped} 个匹配文件未读取，单次最多 {max_files} 个]"))
+    return results
+
+def smart_format(data, max_depth=2, max_str_len=100, omit_str=' ... ', budget=12000):
+    '''字符串按 max_str_len 保留首尾；其他对象由 budget_json 一次遍历序列化，总长度受 budget 约束'''
+    if isinstance(data, str):
+        if len(data) < max_str_len+len(omit_str)*2: return data
+        return f"{data[:max_str_len//2]}{omit_str}{data[-max_str_len//2:]}"
+    if isinstance(data, bytes): return data
+    return budget_json(data, budget, max_str_len, max_depth, omit_str, indent=2)
 
 class GenericAgentHandler(BaseHandler):
     '''Generic Agent 工具库，包含多种工具的实现。工具函数自动加上了 do_ 前缀。实际工具名没有前缀。
     '''
-    def __init__(self, parent, last_history=None, cwd='./'):
+    def __init__(self, parent, last_history=None, cwd='./', persistent_python=False, py_pool=None, persistent_shell=False, print_anchor=False):
         self.parent = parent
         self.key_info = ""
         self.related_sop = ""
         self.cwd = cwd
         self.history_info = last_history if last_history else []
-        self.code_stop_signal = []
+        # WORKING MEMORY 增量发送：(已送达的历史条数, 已送达的 key_info/related_sop)，None 表示需要完整重发
+        self.anchor_sent = self.anchor_pending = (0, None)
+        self._anchor_cache, self.print_anchor = (None, ""), print_anchor
+        # 幂等工具的结果缓存：key -> (validator, 产生结果的轮次, 相关文件路径)；只在结果仍完整留在模型上下文中时命中
+        self.turn, self.result_cache, self.result_cache_turns = 0, {}, 1
+        self.cache_stats, self.cache_lock = {"hits": 0, "misses": 0}, threading.Lock()
+        self.code_stop_signal = StopSignal()
+        self.bg_jobs = {}
+        self.code_timings = collections.deque(maxlen=200)   # 最近 code_run 的首输出耗时/总耗时，见 get_code_timing_stats
+        self.py_worker, self.py_pool = None, py_pool   # py_pool 由调用方持有，跨任务共享
+        if persistent_python:
+            from pyworker import PyWorker
+            self.py_worker = PyWorker()
+        self.shell = None
+        if persistent_shell:
+            from pyworker import ShellSession
+            self.shell = ShellSession(script_dir=os.path.abspath(cwd))
+
+    def close(self):
+        '''任务结束时释放常驻资源'''
+        if self.py_worker is not None: self.py_worker.close()
+        if self.shell is not None: self.shell.close()
+        for job in self.bg_jobs.values(): job.cancel()
+        st = self.get_cache_stats()
+        if st["hits"]: print(f"[Info] tool result cache: {st['hits']}/{st['hits'] + st['misses']} hits ({st['hit_rate']:.0%})")
+        for typ, t in self.get_code_timing_stats().items():
+            print(f"[Info] code_run {typ}: {t['runs']} runs, first output median {t['first_output_median']}s, duration median {t['duration_median']}s / max {t['duration_max']}s")
+
+    def get_code_timing_stats(self):
+        '''按代码类型汇总最近 code_run 的耗时（秒）：次数、首输出耗时中位数、总耗时中位数与最大值'''
+        by_type = collections.defaultdict(list)
+        for t in list(self.code_timings): by_type[t["type"]].append(t)
+        def median(xs): return sorted(xs)[len(xs) // 2] if xs else None
+        return {typ: {"runs": len(ts), "first_output_median": median([t["first_output"] for t in ts if t.get("first_output") is not None]),
+                      "duration_median": median([t["duration"] for t in ts if "duration" in t]),
+                      "duration_max": max((t["duration"] for t in ts if "duration" in t), default=None)} for typ, ts in by_type.items()}
+
+    def get_cache_stats(self):
+        with self.cache_lock: st = dict(self.cache_stats, entries=len(self.result_cache))
+        total = st["hits"] + st["misses"]
+        st["hit_rate"] = round(st["hits"] / total, 3) if total else 0.0
+        return st
+
+    def _cache_key(self, tool_name, args): return tool_name + json.dumps(args, sort_keys=True, ensure_ascii=False, default=str)
+
+    def _cache_lookup(self, key, validator):
+        '''validator 与缓存一致且结果产生于最近 result_cache_turns 轮内（更早的 tool_result 已被会话压缩）时返回该轮次。
+        上下文重置（含后端不保存历史的每一轮）时 on_new_turn 清空缓存，模型看不到的结果不会被引用'''
+        if validator is None: return None
+        with self.cache_lock:
+            hit = self.result_cache.get(key)
+            if hit and hit[0] == validator and self.turn - hit[1] <= self.result_cache_turns:
+                self.cache_stats["hits"] += 1; return hit[1]
+            self.cache_stats["misses"] += 1
+
+    def _cache_store(self, key, validator, path=None):
+        if validator is None: return
+        with self.cache_lock: self.result_cache[key] = (validator, self.turn, path)
+
+    def _file_validator(self, path):
+        try: st = os.stat(path)
+        except OSError: return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def can_parallel(self, tool_name, args):
+        # 只读且互不依赖的调用允许同轮并发；切换标签页等有状态操作仍顺序执行
+        if tool_name == 'web_scan': return args.get('tabs_only', False) and not args.get('switch_tab_id')
+        if tool_name == 'code_job': return args.get('action', 'poll') != 'cancel'
+        return tool_name in ('file_read', 'file_read_batch', 'search', 'memory_search')
+
+    def merge_next_prompts(self, prompts):
+        # 并发批次中每个工具都附带了WORKING MEMORY，合并时去重并只保留一份最新的
+        anchor = r"\n### \[WORKING MEMORY\][^\n]*(\n<history>.*?</history>)?(\n<key_info>.*?</key_info>)?(\n有不清晰的地方请再次读取[^\n]*)?"
+        bodies = [re.sub(anchor, "", p, flags=re.DOTALL).strip() for p in prompts if p]
+        return "\n".join(dict.fromkeys(b for b in bodies if b)) + self._get_anchor_prompt()
 
     def _get_abs_path(self, path):
         if not path: return ""
         return os.path.abspath(os.path.join(self.cwd, path))
     
+    def _call_slot(self, response, match):
+        '''本次调用在同一回复内满足 match(name, args) 的调用中的序号与总数；单独调用时为 (0, 1)'''
+        calls, i = getattr(response, 'calls', None), getattr(response, 'call_index', 0)
+        if not calls: return 0, 1
+        same = [k for k, (n, a) in enumerate(calls) if match(n, a)]
+        return (same.index(i) if i in same else 0), max(1, len(same))
+
     def tool_after_callback(self, tool_name, args, response, ret):
+        if getattr(response, 'call_index', 0) > 0: return   # <summary> 每轮一条，只随第一个调用记入历史
         rsumm = re.search(r"<summary>(.*?)</summary>", response.content, re.DOTALL)
         if rsumm: summary = rsumm.group(1).strip()[:200]
         else:
@@ -257,20 +780,51 @@ class GenericAgentHandler(BaseHandler):
         # 从 response.content 中提取代码块, 匹配 ```python ... ``` 或 ```powershell ... ```
         pattern = rf"```{code_type}\n(.*?)\n```"
         matches = re.findall(pattern, response.content, re.DOTALL)
+        nth, total = self._call_slot(response, lambda n, a: n == 'code_run' and a.get("type", "python") == code_type)
+        if total > 1 and len(matches) < total: matches = []   # 多次调用时代码块按顺序与调用一一对应，对不上时只能用参数中的 code
         warning = ""
         if not matches:
             code = args.get("code")
-            if not code: return StepOutcome(None, next_prompt=f"【系统错误】：你调用了 code_run，但未在先在回复正文中提供 ```{code_type} 代码块。请重新输出代码并附带工具调用。")
+            if not code:
+                if total > 1: return StepOutcome(None, next_prompt=f"【系统错误】：本轮调用了 {total} 次 {code_type} code_run，正文中的 ```{code_type} 代码块数量与之不符。"
+                                                                   "多次调用按顺序各对应一个代码块，请补齐后重新调用。")
+                return StepOutcome(None, next_prompt=f"【系统错误】：你调用了 code_run，但未在先在回复正文中提供 ```{code_type} 代码块。请重新输出代码并附带工具调用。")
             warning = "\n下次要记得先在回复正文中提供代码块，而不是放在参数中"
+        elif total > 1: code = matches[nth].strip()
         else: code = matches[-1].strip()   # 提取最后一个代码块（通常是模型修正后的最终逻辑）
         timeout = args.get("timeout", 60)
         raw_path = os.path.join(self.cwd, args.get("cwd", './'))
         cwd = os.path.normpath(os.path.abspath(raw_path))
         code_cwd = os.path.normpath(self.cwd)
-        result = yield from code_run(code, code_type, timeout, cwd, code_cwd=code_cwd, stop_signal=self.code_stop_signal)
+        if args.get("background"):
+            job_id = f"job{len(self.bg_jobs)+1}"
+            try: job = BgJob(job_id, code, code_type, cwd, code_cwd=code_cwd, timeout=args.get("timeout"))
+            except Exception as e: return StepOutcome({"status": "error", "msg": str(e)}, next_prompt=self._get_anchor_prompt() + warning)
+            self.bg_jobs[job_id] = job
+            yield f"[Action] Started background {code_type} job {job_id} in {os.path.basename(cwd)}: {job.preview}\n"
+            result = {"status": "started", "job_id": job_id, "msg": "后台运行中，用 code_job 工具查询输出或取消"}
+            return StepOutcome(result, next_prompt=self._get_anchor_prompt() + warning)
+        timing = {"type": code_type}
+        worker = (self.py_worker or self.py_pool) if code_type == "python" else self.shell
+        result = yield from code_run(code, code_type, timeout, cwd, code_cwd=code_cwd, stop_signal=self.code_stop_signal,
+                                     worker=worker, timing=timing)
+        self.code_timings.append(timing)
         next_prompt = self._get_anchor_prompt() + warning
         return StepOutcome(result, next_prompt=next_prompt)
     
+    def do_code_job(self, args, response):
+        '''管理 code_run(background=true) 启动的后台作业：poll 查看状态和新输出，tail 查看最后若干行，cancel 取消。
+        不提供 job_id 时列出全部作业。
+        '''
+        job_id, action = args.get("job_id"), args.get("action", "poll")
+        if not job_id: result = {"status": "success", "jobs": [j.info() for j in self.bg_jobs.values()]}
+        elif job_id not in self.bg_jobs: result = {"status": "error", "msg": f"未知作业 {job_id}，现有: {list(self.bg_jobs)}"}
+        elif action == "tail": result = self.bg_jobs[job_id].tail(int(args.get("lines", 50)))
+        elif action == "cancel": result = self.bg_jobs[job_id].cancel()
+        else: result = self.bg_jobs[job_id].poll()
+        yield f"[Info] code_job {action} {job_id or '(all)'}: {result.get('status')}\n"
+        return StepOutcome(result, next_prompt=self._get_anchor_prompt())
+
     def do_ask_user(self, args, response):
         question = args.get("question", "请提供输入：")
         candidates = args.get("candidates", [])
@@ -284,7 +838,15 @@ class GenericAgentHandler(BaseHandler):
         '''
         tabs_only = args.get("tabs_only", False)
         switch_tab_id = args.get("switch_tab_id", None)
+        validator, key = None, self._cache_key("web_scan", args)
+        if tabs_only and not switch_tab_id and driver is not None and not driver.is_remote:
+            validator = (id(driver), driver.version, driver.default_session_id)
+        turn = self._cache_lookup(key, validator)
+        if turn is not None:
+            yield f"[Info] 标签页列表未变化（第 {turn} 轮）\n"
+            return StepOutcome({"status": "unchanged", "msg": f"标签页列表与第 {turn} 轮 web_scan 的结果相同，请直接参考该轮结果"}, next_prompt="标签页列表如上\n")
         result = web_scan(tabs_only=tabs_only, switch_tab_id=switch_tab_id)
+        if result.get("status") == "success": self._cache_store(key, validator)
         content = result.pop("content", None)
         yield f'[Info] {str(result)}\n'
         if content: next_prompt = f"```html\n{content}\n```"
@@ -307,17 +869,74 @@ class GenericAgentHandler(BaseHandler):
                 result["js_return"] += f"\n\n[已保存以上内容到 {abs_path}]"
             except:
                 result['js_return'] += f"\n\n[保存失败，无法写入文件 {abs_path}]"
-        print("Web Execute JS Result:", smart_format(result))
-        yield f"JS 执行结果:\n{smart_format(result)}\n"
+        shown = smart_format(result)
+        print("Web Execute JS Result:", shown)
+        yield f"JS 执行结果:\n{shown}\n"
         next_prompt = self._get_anchor_prompt()
         return StepOutcome(smart_format(result, max_str_len=5000), next_prompt=next_prompt)
     
+    def do_search(self, args, response):
+        '''在工作目录和 memory/ 中全文检索（持久化索引，增量更新），返回按相关度排序、带行号的有界结果。
+        比用 code_run 调 grep/findstr 快且输出可控。path 可指定其它目录作为检索范围。
+        '''
+        query = args.get("query", "")
+        if not query: return StepOutcome({"status": "error", "msg": "query 不能为空"}, next_prompt=self._get_anchor_prompt())
+        from codesearch import get_index, format_results, default_store_path
+        roots = [self._get_abs_path(args["path"])] if args.get("path") else self._search_roots()
+        yield f"[Action] Searching '{query}' in {', '.join(os.path.basename(r) for r in roots)}\n"
+        index = get_index(default_store_path(self.cwd))
+        res = index.search(roots, query, regex=args.get("regex", False), case_sensitive=args.get("case_sensitive", False),
+                           max_results=min(int(args.get("max_results", 30)), 200))
+        result = format_results(res, query, base=os.path.abspath(self.cwd))
+        yield result.split("\n", 1)[0] + "\n"
+        return StepOutcome(result, next_prompt=self._get_anchor_prompt())
+
+    def do_memory_search(self, args, response):
+        '''在记忆库（../memory/ 下的 SOP 与 global_mem.txt）中按相关度检索，返回按标题切分的片段及行号，
+        代替整篇读取 SOP；需要完整上下文时再用 file_read 的 start 读取。
+        '''
+        query = args.get("query", "")
+        if not query: return StepOutcome({"status": "error", "msg": "query 不能为空"}, next_prompt=self._get_anchor_prompt())
+        from memsearch import get_memory_index, format_hits
+        yield f"[Action] Searching memory for '{query}'\n"
+        hits = get_memory_index(self._memory_dir()).search(query, top_k=min(int(args.get("top_k", 5)), 20))
+        result = format_hits(hits, base=os.path.abspath(self.cwd)) or "记忆库中无相关内容"
+        yield f"[Status] {len(hits)} snippets\n"
+        return StepOutcome(result, next_prompt=self._get_anchor_prompt())
+
+    def _memory_dir(self): return os.path.abspath(os.path.join(self.cwd, '..', 'memory'))
+
+    def _search_roots(self):
+        roots = [os.path.abspath(self.cwd), self._memory_dir()]
+        return [r for r in roots if os.path.isdir(r)]
+
+    def _on_file_written(self, path):
+        '''本 handler 的文件工具修改文件后调用，使相关缓存/索引立即失效'''
+        invalidate_cached(path)    # memory/ 下的记忆文件、assets 下的提示词
+        path = os.path.abspath(path)
+        with self.cache_lock:
+            for k in [k for k, v in self.result_cache.items() if v[2] == path]: del self.result_cache[k]
+        if 'memsearch' in sys.modules:
+            for index in sys.modules['memsearch']._indexes.values(): index.forget(path)
+        if 'codesearch' in sys.modules:
+            for index in sys.modules['codesearch']._indexes.values(): index.update_file(path)
+
     def do_file_patch(self, args, response):
+        '''单块 patch，或通过 hunks 一次提交多块（可跨文件）修改：全部唯一匹配才原子写入，否则都不改。'''
         path = self._get_abs_path(args.get("path", ""))
-        yield f"[Action] Patching file: {path}\n"
-        old_content = args.get("old_content", "")
-        new_content = args.get("new_content", "")
-        result = file_patch(path, old_content, new_content)
+        hunks = args.get("hunks")
+        if not hunks:
+            yield f"[Action] Patching file: {path}\n"
+            result = file_patch(path, args.get("old_content", ""), args.get("new_content", ""))
+            if result.get("status") == "success": self._on_file_written(path)
+        else:
+            hunks = [(self._get_abs_path(h.get("path")) if h.get("path") else path, h.get("old_content", ""), h.get("new_content", "")) for h in hunks]
+            yield f"[Action] Patching {len(hunks)} hunks in {len(set(h[0] for h in hunks))} files\n"
+            ok, report = file_patch_hunks(hunks)
+            for p in (set(h[0] for h in hunks) if ok else ()): self._on_file_written(p)
+            result = {"status": "success" if ok else "error",
+                      "msg": f"{len(hunks)} 块修改全部成功" if ok else "部分块匹配失败，所有文件均未修改，请根据各块状态修正后整体重试",
+                      "hunks": [{k: v for k, v in r.items() if k != "msg" or r["status"] != "ok"} for r in report]}
         yield f"\n{smart_format(result)}\n"
         next_prompt = self._get_anchor_prompt()
         return StepOutcome(result, next_prompt=next_prompt)
@@ -337,37 +956,55 @@ class GenericAgentHandler(BaseHandler):
             s, e = text.find("```"), text.rfind("```")
             if -1 < s < e: return text[text.find("\n", s)+1 : e].strip()
             return None
-        
-        blocks = extract_robust_content(response.content)
+
+        nth, total = self._call_slot(response, lambda n, a: n == 'file_write')
+        calls = getattr(response, 'calls', None) or []
+        if len(calls) <= 1: blocks = extract_robust_content(response.content)
+        else:   # 同一回复中还有其它调用：按顺序各取一个 <file_content>；没有时取代码块，但跳过 code_run 要执行的那些
+            parts = re.findall(r"<file_content>(.*?)</file_content>", response.content, re.DOTALL)
+            if not parts:
+                run_types = {a.get("type", "python") for n, a in calls if n == 'code_run'}
+                parts = [body for lang, body in re.findall(r"```([^\n]*)\n(.*?)```", response.content, re.DOTALL) if lang.strip() not in run_types]
+                if len(parts) != total: parts = []   # 代码块与调用对不上时无法判断归属
+            if len(parts) < total:
+                yield f"[Status] ❌ 失败: 本轮 {total} 次 file_write 只找到 {len(parts)} 段可确定归属的内容\n"
+                return StepOutcome({"status": "error", "msg": f"本轮回复包含多个工具调用，file_write 的内容无法确定归属（找到 {len(parts)} 段，需要 {total} 段）。"
+                                    "请把每次 file_write 的内容分别放进 <file_content> 块，按调用顺序排列，所有文件均未写入本次内容"}, next_prompt="\n")
+            blocks = parts[nth].strip()
         if not blocks:
             yield f"[Status] ❌ 失败: 未在回复中找到代码块内容\n"
             return StepOutcome({"status": "error", "msg": "No content found, if you want a blank, you should use code_run"}, next_prompt="\n")
         new_content = blocks
         try:
-            if mode == "prepend":
-                old = open(path, 'r', encoding="utf-8").read() if os.path.exists(path) else ""
-                open(path, 'w', encoding="utf-8").write(new_content + old)
-            else:
-                with open(path, 'a' if mode == "append" else 'w', encoding="utf-8") as f:
-                    f.write(new_content)
-            yield f"[Status] ✅ {mode.capitalize()} 成功 ({len(new_content)} bytes)\n"
+            nbytes = write_file_safe(path, new_content, mode)
+            self._on_file_written(path)
+            yield f"[Status] ✅ {mode.capitalize()} 成功 ({nbytes} bytes)\n"
             next_prompt = self._get_anchor_prompt()
-            return StepOutcome({"status": "success", 'writed_bytes': len(new_content)}, 
+            return StepOutcome({"status": "success", 'writed_bytes': nbytes}, 
                                next_prompt=next_prompt)
         except Exception as e:
             yield f"[Status] ❌ 写入异常: {str(e)}\n"
             return StepOutcome({"status": "error", "msg": str(e)}, next_prompt="\n")
         
     def do_file_read(self, args, response):
-        '''读取文件内容。从第start行开始读取。如有keyword则返回第一个keyword(忽略大小写)周边内容'''
+        '''读取文件内容。从第start行开始读取。如有keyword则返回第match_index个匹配(默认忽略大小写)周边内容，
+        regex=true 时 keyword 作为正则；list_matches=true 时只列出所有匹配的行号及行内容。
+        '''
         path = self._get_abs_path(args.get("path", ""))
         yield f"\n[Action] Reading file: {path}\n"
         start = args.get("start", 1)
         count = args.get("count", 100)
         keyword = args.get("keyword")
         show_linenos = args.get("show_linenos", True)
-        result = file_read(path, start=start, keyword=keyword,
-                           count=count, show_linenos=show_linenos)
+        key, validator = self._cache_key("file_read", dict(args, path=path)), self._file_validator(path)
+        turn = self._cache_lookup(key, validator)
+        if turn is not None:
+            yield f"[Info] 文件未变化，沿用第 {turn} 轮的读取结果\n"
+            return StepOutcome(f"[unchanged] 文件自第 {turn} 轮以相同参数读取后未被修改，内容与该轮结果完全相同，请直接参考该轮结果。", next_prompt=self._get_anchor_prompt())
+        result = file_read(path, start=start, keyword=keyword, count=count, show_linenos=show_linenos,
+                           regex=args.get("regex", False), case_sensitive=args.get("case_sensitive", False),
+                           match_index=args.get("match_index", 1), list_matches=args.get("list_matches", False))
+        if not result.startswith("Error:"): self._cache_store(key, validator, path)
         if show_linenos:
             tips = '由于设置了show_linenos，以下返回信息为：(行号|)内容 。\n'
             result = tips + result 
@@ -376,6 +1013,21 @@ class GenericAgentHandler(BaseHandler):
             next_prompt += "\nPROTOCOL: 你正在读取记忆或SOP文件，若决定按sop执行请先调用相关工具提取sop中的关键点（特别是靠后的）进入工作记忆。"
         return StepOutcome(result, next_prompt=next_prompt)
     
+    def do_file_read_batch(self, args, response):
+        '''一次并发读取多个文件/glob，每项可单独指定 start/count/keyword，总输出在文件间公平分配字符预算。'''
+        files = args.get("files") or []
+        if isinstance(files, (str, dict)): files = [files]
+        budget = min(int(args.get("budget", 20000)), 60000)
+        yield f"\n[Action] Batch reading {len(files)} entries\n"
+        results = file_read_batch(files, cwd=self.cwd, budget=budget)
+        yield f"[Info] Read {len(results)} files\n"
+        body = "\n\n".join(f"==== {p} ====\n{t}" if p else t for p, t in results)
+        result = '以下返回信息为：(行号|)内容 。\n' + (body or "没有匹配的文件")
+        next_prompt = self._get_anchor_prompt()
+        if any('memory' in p or 'sop' in p for p, _ in results): 
+            next_prompt += "\nPROTOCOL: 你正在读取记忆或SOP文件，若决定按sop执行请先调用相关工具提取sop中的关键点（特别是靠后的）进入工作记忆。"
+        return StepOutcome(result, next_prompt=next_prompt)
+
     def do_update_working_mem(self, args, response):
         '''读取完sop后，为整个任务设定后续需要临时记忆的重点。
         '''
@@ -446,20 +1098,70 @@ class GenericAgentHandler(BaseHandler):
         else: result = "Memory Management SOP not found. Do not update memory."
         return StepOutcome(result, next_prompt=prompt)
 
+    def on_new_turn(self, context_reset=False):
+        self.anchor_sent = (0, None) if context_reset else self.anchor_pending
+        self.turn += 1
+        if context_reset:
+            with self.cache_lock: self.result_cache.clear()
+
     def _get_anchor_prompt(self):
-        h_str = "\n".join(self.history_info[-20:])
-        prompt = f"\n### [WORKING MEMORY]\n<history>\n{h_str}\n</history>"
-        if self.key_info: prompt += f"\n<key_info>{self.key_info}</key_info>"
-        if self.related_sop: prompt += f"\n有不清晰的地方请再次读取{self.related_sop}"
-        try: print(prompt)
-        except: pass
-        return prompt
+        '''模型侧会话保留了完整历史，因此只附带上次送达后新增的 history，key_info/related_sop 变化时才重发；
+        会话被摘要/裁剪、换后端，或后端本身不保存历史时(on_new_turn 的 context_reset)完整重发最近 20 条。同一轮内多次调用结果相同。
+        '''
+        sent, sent_state = self.anchor_sent
+        n, state = len(self.history_info), (self.key_info, self.related_sop)
+        key = (sent, sent_state, n, state)
+        if self._anchor_cache[0] != key:
+            full = sent_state is None
+            start = max(0 if full else sent, n - 20)
+            prompt = ""
+            if full or start < n:
+                h_str = "\n".join(self.history_info[start:n])
+                prompt += f"\n<history>\n{h_str}\n</history>"
+            if self.key_info and (full or self.key_info != sent_state[0]): prompt += f"\n<key_info>{self.key_info}</key_info>"
+            if self.related_sop and (full or self.related_sop != sent_state[1]): prompt += f"\n有不清晰的地方请再次读取{self.related_sop}"
+            if prompt: prompt = "\n### [WORKING MEMORY]" + ("" if full else " (新增部分，之前的见上文)") + prompt
+            self._anchor_cache = (key, prompt)
+            if self.print_anchor:
+                try: print(prompt)
+                except: pass
+        self.anchor_pending = (n, state)
+        return self._anchor_cache[1]
+
+_file_cache = {}   # (abspath, loader) -> ((mtime_ns, size), 内容)
+def read_cached(path, loader=None):
+    '''按 (mtime, size) 缓存的 utf-8 文本读取，未变化时只做一次 stat；loader 可对文本做解析，解析结果一并缓存。
+    文件不存在时抛 FileNotFoundError。本进程的文件工具写入后由 invalidate_cached 显式失效（mtime 精度不足时也不会读到旧内容）。
+    '''
+    key = (os.path.abspath(path), loader)
+    st = os.stat(key[0])
+    sig = (st.st_mtime_ns, st.st_size)
+    hit = _file_cache.get(key)
+    if hit and hit[0] == sig: return hit[1]
+    with open(key[0], 'r', encoding='utf-8') as f: data = f.read()
+    if loader is not None: data = loader(data)
+    _file_cache[key] = (sig, data)
+    return data
+
+def invalidate_cached(path):
+    path = os.path.abspath(path)
+    for key in [k for k in _file_cache if k[0] == path]: del _file_cache[key]
+
+def get_memory_snippets(query, top_k=3, memory_dir='memory', max_chars=600):
+    '''按任务描述从记忆库检索 top_k 个相关片段，用于注入系统提示；无结果时返回空串'''
+    from memsearch import get_memory_index, format_hits
+    try: hits = get_memory_index(memory_dir).search(query, top_k=top_k)
+    except Exception as e:
+        print(f"[Warn] memory search failed: {e}"); return ""
+    if not hits: return ""
+    return "\n[Related Memory] 按当前任务自动检索的记忆片段（路径相对代码目录，需要完整内容用 file_read 读取 ../ 下对应文件）:\n" + \
+           format_hits(hits, base=os.path.dirname(os.path.abspath(memory_dir)), max_chars=max_chars) + "\n"
 
 def get_global_memory():
     prompt = "\n"
     try:
-        with open('memory/global_mem_insight.txt', 'r', encoding='utf-8') as f: insight = f.read()
-        with open('assets/insight_fixed_structure.txt', 'r', encoding='utf-8') as f: structure = f.read()
+        insight = read_cached('memory/global_mem_insight.txt')
+        structure = read_cached('assets/insight_fixed_structure.txt')
         prompt += f"\n[Memory]\n"
         prompt += 'IMPORTANT PATHS: ../memory/global_mem.txt (Facts), ../ (Your Code Dir)\n'
         prompt += f'cwd = {os.path.abspath("./temp")}\n'
@@ -0,0 +1,109 @@
+import os, re, math, threading, collections
+
+# 记忆库检索。memory/ 下的 *.md 与 global_mem.txt 按标题切块（代码块内的 # 注释不算标题，过长的块再按行切分），
+# 每块统计词频，用 BM25 排序返回带行号的片段，省去整篇读取 SOP 的轮次和 token。
+# 文件按 (mtime, size) 增量重新切块；倒排表只在有变化后的下一次查询时由已缓存的词频重建，不重读文件。
+HEADING = re.compile(r'^#{1,6}\s+\S')
+TOKEN = re.compile(r'[a-z0-9_]+|[㐀-鿿豈-﫿]+')
+MAX_CHUNK_LINES = 60
+
+def tokenize(text):
+    '''英文/数字按词（小写），中日文按相邻二字组；单个汉字按字'''
+    out = []
+    for t in TOKEN.findall(text.lower()):
+        if t[0] < '㐀': out.append(t)
+        elif len(t) == 1: out.append(t)
+        else: out += [t[i:i+2] for i in range(len(t) - 1)]
+    return out
+
+def split_chunks(text):
+    '''返回 [(起始行号, 结束行号, 标题, 文本)]，行号从 1 开始'''
+    lines = text.split('\n')
+    bounds, fence = [0], False
+    for i, line in enumerate(lines):
+        if line.lstrip().startswith('```'): fence = not fence
+        elif not fence and i > 0 and HEADING.match(line): bounds.append(i)
+    bounds.append(len(lines))
+    chunks = []
+    for s, e in zip(bounds, bounds[1:]):
+        heading = lines[s].lstrip('#').strip() if HEADING.match(lines[s]) else ''
+        for cs in range(s, e, MAX_CHUNK_LINES):
+            ce = min(cs + MAX_CHUNK_LINES, e)
+            body = '\n'.join(lines[cs:ce])
+            if body.strip(): chunks.append((cs + 1, ce, heading, body))
+    return chunks
+
+class MemoryIndex:
+    def __init__(self, root, k1=1.5, b=0.75):
+        self.root, self.k1, self.b = os.path.abspath(root), k1, b
+        self.files = {}        # path -> ((mtime_ns, size), [(start, end, heading, text, Counter)])
+        self.postings, self.doclen, self.docs = None, [], []
+        self.lock = threading.Lock()
+
+    def sources(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.') and d != '__pycache__']
+            for fn in filenames:
+                if fn.endswith('.md') or (dirpath == self.root and fn == 'global_mem.txt'): yield os.path.join(dirpath, fn)
+
+    def forget(self, path):
+        '''文件被本进程修改后调用，下次查询时无论 mtime 是否变化都重新切块'''
+        with self.lock:
+            if self.files.pop(os.path.abspath(path), None) is not None: self.postings = None
+
+    def refresh(self):
+        seen = set()
+        for p in self.sources():
+            seen.add(p)
+            try: st = os.stat(p)
+            except OSError: continue
+            sig = (st.st_mtime_ns, st.st_size)
+            old = self.files.get(p)
+            if old and old[0] == sig: continue
+            try:
+                with open(p, 'r', encoding='utf-8', errors='replace') as f: text = f.read()
+            except OSError: continue
+            chunks = [(s, e, h, t, collections.Counter(tokenize(h + '\n' + t))) for s, e, h, t in split_chunks(text)]
+            with self.lock: self.files[p] = (sig, chunks); self.postings = None
+        with self.lock:
+            for p in [p for p in self.files if p not in seen]: del self.files[p]; self.postings = None
+
+    def _build(self):
+        postings, docs, doclen = collections.defaultdict(list), [], []
+        for p, (_, chunks) in self.files.items():
+            for s, e, h, t, tf in chunks:
+                d = len(docs); docs.append((p, s, e, h, t)); doclen.append(sum(tf.values()))
+                for term, n in tf.items(): postings[term].append((d, n))
+        self.postings, self.docs, self.doclen = postings, docs, doclen
+
+    def search(self, query, top_k=5):
+        '''返回 [(score, path, start, end, heading, text)]，按 BM25 得分降序'''
+        self.refresh()
+        with self.lock:
+            if self.postings is None: self._build()
+            postings, docs, doclen = self.postings, self.docs, self.doclen
+        if not docs: return []
+        avgdl, N, scores = sum(doclen) / len(doclen), len(docs), collections.defaultdict(float)
+        for term in set(tokenize(query)):
+            plist = postings.get(term)
+            if not plist: continue
+            idf = math.log(1 + (N - len(plist) + 0.5) / (len(plist) + 0.5))
+            for d, n in plist:
+                scores[d] += idf * n * (self.k1 + 1) / (n + self.k1 * (1 - self.b + self.b * doclen[d] / avgdl))
+        best = sorted(scores.items(), key=lambda x: -x[1])[:top_k]
+        return [(round(sc, 2),) + docs[d] for d, sc in best]
+
+def format_hits(hits, base=None, max_chars=800):
+    out = []
+    for score, p, s, e, h, text in hits:
+        rel = os.path.relpath(p, base) if base else p
+        body = '\n'.join(f"{s+i}|{l}" for i, l in enumerate(text.split('\n')))
+        if len(body) > max_chars: body = body[:max_chars] + f"\n... (截断，可用 file_read start={s} 读取完整段落)"
+        out.append(f"--- {rel}:{s}-{e}" + (f"  [{h}]" if h else "") + f"  score={score}\n{body}")
+    return "\n".join(out)
+
+_indexes = {}
+def get_memory_index(root):
+    root = os.path.abspath(root)
+    if root not in _indexes: _indexes[root] = MemoryIndex(root)
+    return _indexes[root]
@@ -20,7 +20,8 @@ oai_config2 = {
 claude_config = {
     'apikey':'klURcj...',
     'apibase':"http://233.145.139.147:3001/",
-    'model':"claude-opus"
+    'model':"claude-opus",
+    # 'prompt_cache': False,   # 默认开启 Anthropic prompt caching；离线调试可把 apibase 指向 assets/claude_mock_server.py
 }
 
 # If you need them
@@ -28,3 +29,31 @@ claude_config = {
 # tg_allowed_users = [6806...]
 
 # proxy = "http://127.0.0.1:2082"
+
+# 增量提示中工具协议只发简短说明，累计发送约这么多 token 后重发一次完整工具 schema
+# tools_reminder_tokens = 1500
+
+# 与 LLM 后端之间的 keep-alive 连接池：每个后端的连接数、建连失败/429/5xx 的重试次数、(连接, 读取) 超时秒数
+# http_pool_size = 4
+# http_retries = 2
+# http_timeout = (5, 60)
+# 配置了多个 Claude/OpenAI 兼容后端时：当前后端报错或首块超过 llm_ttft_timeout 秒未到，自动转到下一个后端，之后的任务也继续用它。
+# 接手的后端先复制当前后端的对话历史，它自己原有的历史会被替换（暂存，可用 agent.llmclient.router.restore_history(后端) 恢复）。
+# Sider/Gemini 等不保存历史的后端不参与切换。
+# llm_failover = True
+# llm_ttft_timeout = 60
+# 对冲请求：首块等待超过当前后端历史首块延迟的该分位数时，同时请求下一个后端，取先输出的一方
+# llm_hedge = True
+# llm_hedge_percentile = 0.9
+
+# code_run 使用常驻 Python 解释器（省去每次启动和重复 import 的开销）
+# code_run_persistent = True
+# 或：预启动的一次性解释器池，已预先 import 指定模块（用完即弃，后台补充）
+# code_run_pool = 2
+# code_run_preload = ['requests', 'bs4', 'numpy']
+# bash/powershell 使用常驻 shell，cd、环境变量、激活的 venv 在多次 code_run 间保留
+# code_run_shell_session = True
+# 任务开始时按任务描述从 memory/ 检索相关片段注入系统提示（条数，0 为关闭）
+# memory_inject_topk = 3
+# 每轮在控制台打印附加给模型的 WORKING MEMORY（调试用）
+# print_anchor = True
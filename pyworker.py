@@ -0,0 +1,254 @@
+import os, sys, json, time, uuid, signal, tempfile, threading, subprocess, traceback
+
+# 常驻 Python 解释器：省掉每次 code_run 的解释器启动和 numpy/requests 等重复 import。
+# 子进程通过 stdin 接收作业(JSON一行)，每个作业在全新命名空间中运行，输出直接写入 stdout 管道，
+# 结束时写出带 token 的哨兵行报告退出码。作业被 kill 或进程崩溃后，下次提交时自动重启。
+# ShellSession 用同样的哨兵协议维持常驻 bash/powershell，保留 cd、环境变量和激活的 venv。
+SENTINEL = b'\x1e\x1ePYWORKER_DONE:'
+READY = b'\x1e\x1ePYWORKER_READY\n'
+
+def _startupinfo():
+    if os.name != 'nt': return None
+    si = subprocess.STARTUPINFO()
+    si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    si.wShowWindow = 0 # SW_HIDE
+    return si
+
+class PyJob:
+    '''PyWorker 中的一次作业。提供 code_run 用到的 Popen 子集接口：stdout.readline/poll/wait/kill'''
+    def __init__(self, worker, token):
+        self.worker, self.marker = worker, SENTINEL + token.encode() + b':'
+        self.proc = worker.proc    # worker 重启后旧作业仍读自己的管道
+        self.returncode, self.carry = None, b''
+        self.done = threading.Event()
+        self.stdout = self
+    def _finish(self, code):
+        self.returncode = code; self.done.set()
+        if self.worker.one_shot: self.worker.close()
+    def readline(self, limit=-1):
+        while not self.done.is_set():
+            chunk = self.proc.stdout.readline(limit)
+            line, self.carry = self.carry + chunk, b''
+            if not chunk:
+                self._finish(self.proc.wait()); return line
+            i = line.find(self.marker)
+            if i >= 0: break
+            if not line.endswith(b'\n'):   # 按 limit 切块时哨兵可能被截断，把疑似前缀留到下一块
+                k = next((k for k in range(min(len(self.marker), len(line)), 0, -1) if self.marker.startswith(line[-k:])), 0)
+                if k: line, self.carry = line[:-k], line[-k:]
+            if line: return line
+        else: return b''
+        try: code = int(line[i+len(self.marker):].strip())
+        except ValueError: code = 1
+        self._finish(code)
+        return line[:i]    # 哨兵前可能有未换行的输出
+    def close(self): pass    # 管道属于 worker，作业结束不关闭
+    def poll(self): return self.returncode
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout): raise subprocess.TimeoutExpired('pyworker', timeout)
+        return self.returncode
+    def kill(self):
+        if self.worker.proc is self.proc: self.worker.kill()
+        else: self.proc.kill()
+
+class PyWorker:
+    '''常驻子解释器。submit 返回 PyJob；进程不可用时抛异常，由调用方退回一次性模式'''
+    def __init__(self, preload=(), one_shot=False):
+        self.preload, self.one_shot = list(preload), one_shot
+        self.proc, self.job = None, None
+        self.lock = threading.Lock()
+
+    def alive(self): return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, "-X", "utf8", "-u", os.path.abspath(__file__), "--serve", *self.preload],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            bufsize=0, startupinfo=_startupinfo())
+        self.job = None
+        line = self.proc.stdout.readline()
+        if line != READY:
+            self.kill()
+            raise RuntimeError(f"pyworker failed to start: {line[:200]!r}")
+        return self
+
+    def submit(self, path, cwd):
+        with self.lock:
+            if self.job is not None and not self.job.done.is_set(): raise RuntimeError("pyworker busy")
+            if not self.alive():
+                if self.one_shot and self.proc is not None: raise RuntimeError("pyworker already used")
+                self.start()
+            token = uuid.uuid4().hex
+            self.job = PyJob(self, token)
+            self.proc.stdin.write((json.dumps({"path": path, "cwd": cwd, "token": token}) + "\n").encode('utf-8'))
+            self.proc.stdin.flush()
+            return self.job
+
+    def kill(self):
+        if self.proc is None: return
+        try: self.proc.kill()
+        except OSError: pass
+
+    def close(self):
+        if self.proc is None: return
+        try: self.proc.stdin.close()
+        except OSError: pass
+        self.kill()
+
+class PyWorkerPool:
+    '''预启动 size 个已 import 好 preload 模块的解释器，供一次性 code_run 作业使用。
+    每个作业取走一个空闲 worker，用完即弃（不共享状态），后台补充新的 worker。
+    接口与 PyWorker.submit 相同；池空时抛异常，调用方退回普通子进程。
+    '''
+    def __init__(self, size=2, preload=()):
+        self.size, self.preload = size, list(preload)
+        self.idle, self.pending, self.closed = [], 0, False
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "refills": 0, "refill_failures": 0,
+                      "refill_latency_avg": 0.0, "refill_latency_max": 0.0}
+        self._refill()
+
+    def _refill(self):
+        with self.lock:
+            if self.closed: return
+            need = max(0, self.size - len(self.idle) - self.pending)
+            self.pending += need
+        for _ in range(need): threading.Thread(target=self._spawn, daemon=True).start()
+
+    def _spawn(self):
+        t0 = time.time()
+        try: w = PyWorker(self.preload, one_shot=True).start()
+        except Exception as e:
+            print(f"[Warn] pyworker pool refill failed: {e}"); w = None
+        dt = time.time() - t0
+        with self.lock:
+            self.pending -= 1
+            if w is None: self.stats["refill_failures"] += 1; return
+            if self.closed: w.close(); return
+            st = self.stats; st["refills"] += 1
+            st["refill_latency_avg"] += (dt - st["refill_latency_avg"]) / st["refills"]
+            st["refill_latency_max"] = max(st["refill_latency_max"], dt)
+            self.idle.append(w)
+
+    def acquire(self):
+        w = None
+        with self.lock:
+            while self.idle and w is None:
+                w = self.idle.pop()
+                if not w.alive(): w = None
+            self.stats["hits" if w else "misses"] += 1
+        self._refill()
+        return w
+
+    def submit(self, path, cwd):
+        w = self.acquire()
+        if w is None: raise RuntimeError("pyworker pool empty")
+        return w.submit(path, cwd)
+
+    def get_stats(self):
+        with self.lock:
+            st = dict(self.stats, idle=len(self.idle), pending=self.pending, size=self.size)
+        total = st["hits"] + st["misses"]
+        st["hit_rate"] = round(st["hits"] / total, 3) if total else 0.0
+        return st
+
+    def close(self):
+        with self.lock:
+            self.closed = True; idle, self.idle = self.idle, []
+        for w in idle: w.close()
+
+class ShellSession:
+    '''常驻 bash/powershell。每条命令写入临时脚本后在当前 shell 中 source 执行，
+    cd/export/venv 激活等状态在命令间保留；shell 退出或被 kill（超时/停止）后下次提交自动重启。
+    submit(code, cwd) 返回 PyJob；仅当 cwd 与上次请求的不同时才切换目录，否则沿用 shell 自身的当前目录。
+    '''
+    def __init__(self, script_dir=None):
+        self.one_shot, self.proc, self.job = False, None, None
+        self.script_dir = script_dir
+        self.req_cwd, self.script, self.restarts = None, None, -1
+        self.lock = threading.Lock()
+
+    def alive(self): return self.proc is not None and self.proc.poll() is None
+
+    def start(self, cwd):
+        if os.name == 'nt': cmd = ["powershell", "-NoProfile", "-NonInteractive", "-Command", "-"]
+        else: cmd = ["bash", "--noprofile", "--norc"]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     bufsize=0, cwd=cwd, startupinfo=_startupinfo(), start_new_session=(os.name != 'nt'))
+        self.job, self.req_cwd = None, cwd; self.restarts += 1
+        if os.name == 'nt': self._send("[Console]::Out.Write([string][char]30+[char]30+'PYWORKER_READY'+[char]10)")
+        else: self._send(r"printf '\036\036PYWORKER_READY\n'")
+        line = self.proc.stdout.readline()
+        if line.strip() != READY.strip():
+            self.kill()
+            raise RuntimeError(f"shell session failed to start: {line[:200]!r}")
+
+    def _send(self, line):
+        self.proc.stdin.write((line + "\n").encode('utf-8')); self.proc.stdin.flush()
+
+    def submit(self, code, cwd):
+        with self.lock:
+            if self.job is not None and not self.job.done.is_set(): raise RuntimeError("shell session busy")
+            restarted = not self.alive()
+            if restarted: self.start(cwd)
+            if self.script and os.path.exists(self.script): os.remove(self.script)
+            fd, self.script = tempfile.mkstemp(suffix=".ai.ps1" if os.name == 'nt' else ".ai.sh", dir=self.script_dir)
+            with open(fd, 'w', encoding='utf-8-sig' if os.name == 'nt' else 'utf-8') as f: f.write(code)
+            token = uuid.uuid4().hex
+            self.job = PyJob(self, token)
+            if os.name == 'nt':
+                q = lambda p: "'" + p.replace("'", "''") + "'"
+                cd = f"Set-Location -LiteralPath {q(cwd)}; " if cwd != self.req_cwd else ""
+                self._send(f"{cd}$global:LASTEXITCODE=0; . ([ScriptBlock]::Create([IO.File]::ReadAllText({q(self.script)}))); $__ok=$?; "
+                           f"$__ec = if ($LASTEXITCODE) {{$LASTEXITCODE}} elseif ($__ok) {{0}} else {{1}}; "
+                           f"[Console]::Out.Write([string][char]30+[char]30+'PYWORKER_DONE:{token}:'+$__ec+[char]10)")
+            else:
+                q = lambda p: "'" + p.replace("'", "'\\''") + "'"
+                cd = f"cd {q(cwd)} && " if cwd != self.req_cwd else ""
+                self._send(f"{cd}source {q(self.script)} </dev/null; printf '\\036\\036PYWORKER_DONE:{token}:%d\\n' $?")
+            self.req_cwd = cwd
+            return self.job
+
+    def kill(self):
+        if self.proc is None: return
+        try:
+            if os.name != 'nt': os.killpg(self.proc.pid, signal.SIGKILL)   # 连同 shell 启动的子进程
+            else: self.proc.kill()
+        except OSError: pass
+
+    def close(self):
+        self.kill()
+        if self.script and os.path.exists(self.script): os.remove(self.script)
+
+
+def serve(preload):
+    for m in preload:
+        try: __import__(m)
+        except Exception as e: print(f"[pyworker] preload {m} failed: {e}", file=sys.stderr)
+    # 命令通道另存一份，fd 0 换成 devnull，避免用户代码或其子进程读走作业
+    cmd_in = os.fdopen(os.dup(0), 'r', encoding='utf-8')
+    devnull = os.open(os.devnull, os.O_RDONLY); os.dup2(devnull, 0)
+    base_path, base_cwd = list(sys.path[1:]), os.getcwd()
+    os.write(1, READY)
+    for line in cmd_in:
+        job = json.loads(line); path = job['path']; code = 0
+        try:
+            os.chdir(job.get('cwd') or base_cwd)
+            sys.argv = [path]; sys.path[:] = [os.path.dirname(path)] + base_path
+            import runpy
+            runpy.run_path(path, run_name='__main__')
+        except SystemExit as e:
+            if e.code is None: code = 0
+            elif isinstance(e.code, int): code = e.code
+            else: print(e.code, file=sys.stderr); code = 1
+        except BaseException as e:
+            tb = e.__traceback__   # 去掉 runpy 自身的栈帧，与一次性模式的报错保持一致
+            while tb is not None and tb.tb_frame.f_code.co_filename != path: tb = tb.tb_next
+            traceback.print_exception(type(e), e, tb or e.__traceback__)
+            code = 1
+        try: sys.stdout.flush(); sys.stderr.flush()
+        except Exception: pass
+        os.write(1, SENTINEL + job['token'].encode() + f":{code}\n".encode())
+
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == '--serve':
+    serve(sys.argv[2:])
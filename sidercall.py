@@ -1,4 +1,4 @@
-import os, json, re, time, requests, sys, threading, urllib3
+import os, json, re, time, atexit, hashlib, tempfile, collections, queue, requests, sys, threading, urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 try: import mykey
@@ -13,6 +13,45 @@ google_api_key = mykeys.get("google_api_key")
 proxy = mykeys.get("proxy", 'http://127.0.0.1:2082')
 proxies = {"http": proxy, "https": proxy} if proxy else None
 
+class HTTPPool:
+    '''每个后端一个 keep-alive 连接池，省掉每轮新建 TCP/TLS（及代理）握手。
+    连接池(HTTPAdapter)在线程间共享，requests.Session 按线程各建一个，避免跨线程共用 cookie/headers 状态。
+    只对建连失败和 429/5xx（响应体读取前）重试，流式读取中断不会重放请求。
+    '''
+    def __init__(self, pool_size=None, retries=None, timeout=None):
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        pool_size = pool_size or mykeys.get("http_pool_size", 4)
+        retries = mykeys.get("http_retries", 2) if retries is None else retries
+        self.timeout = timeout or tuple(mykeys.get("http_timeout", (5, 60)))
+        retry = Retry(total=retries, connect=retries, read=0, status=retries, backoff_factor=0.5,
+                      status_forcelist=(429, 500, 502, 503, 504), allowed_methods=None, raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.local, self.lock = threading.local(), threading.Lock()
+        self.stats = {"requests": 0, "errors": 0}
+    def session(self):
+        sess = getattr(self.local, 'session', None)
+        if sess is None:
+            sess = self.local.session = requests.Session()
+            sess.mount("http://", self.adapter); sess.mount("https://", self.adapter)
+        return sess
+    def post(self, url, **kw):
+        kw.setdefault("timeout", self.timeout)
+        with self.lock: self.stats["requests"] += 1
+        try: return self.session().post(url, **kw)
+        except Exception:
+            with self.lock: self.stats["errors"] += 1
+            raise
+    def get_stats(self):
+        '''new_connections 为实际新建的连接数，其余请求复用了已有连接'''
+        managers = [self.adapter.poolmanager] + list(self.adapter.proxy_manager.values())
+        conns = sum(getattr(m.pools.get(k), 'num_connections', 0) for m in managers for k in m.pools.keys())
+        with self.lock: st = dict(self.stats)
+        st["new_connections"] = conns
+        st["reused"] = max(0, st["requests"] - conns)
+        st["reuse_rate"] = round(st["reused"] / st["requests"], 3) if st["requests"] else 0.0
+        return st
+
 class SiderLLMSession:
     def __init__(self, default_model="gemini-3.0-flash"):
         from sider_ai_api import Session
@@ -27,36 +66,141 @@ class SiderLLMSession:
         if stream: return iter([full_text])   # gen有奇怪的空回复或死循环行为，sider足够快
         return full_text   
 
+class TokenEstimator:
+    '''本地 token 估计：分别统计 CJK 字符、ASCII 字母数字、其它符号和空白，乘以各模型家族的标定系数。
+    中文一字约一个 token，len//4 对我们的提示会低估数倍。结果按 (hash, 长度) 缓存，不持有原字符串；消息级缓存见 msg_tokens。
+    可整体替换为其它实现（如真实 BPE），只需提供 count(text) 和 msg_tokens(msg)。
+    '''
+    # (每个 CJK 字, 每个 ASCII 字母数字, 每个其它符号, 每个空白)
+    FAMILIES = {'claude': (1.15, 0.28, 0.55, 0.12), 'openai': (0.8, 0.25, 0.45, 0.1), 'gemini': (0.7, 0.25, 0.45, 0.1),
+                'cn': (0.65, 0.26, 0.45, 0.1), 'generic': (1.0, 0.28, 0.5, 0.12)}
+    CJK = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+    ALNUM = re.compile(r'[A-Za-z0-9]')
+    SPACE = re.compile(r'\s')
+    IMAGE_TOKENS = 1000
+    def __init__(self, family='generic'):
+        self.family = family if family in self.FAMILIES else 'generic'
+        self.coef = self.FAMILIES[self.family]
+        self.cache, self.cache_size = collections.OrderedDict(), 4096
+    def count(self, text):
+        key = (hash(text), len(text))
+        n = self.cache.get(key)
+        if n is None:
+            n = self.cache[key] = self._count(text)
+            if len(self.cache) > self.cache_size:
+                try: self.cache.popitem(last=False)
+                except KeyError: pass
+        return n
+    def _count(self, text):
+        cjk, alnum, space = (len(r.findall(text)) for r in (self.CJK, self.ALNUM, self.SPACE))
+        a, b, c, d = self.coef
+        return int(cjk * a + alnum * b + (len(text) - cjk - alnum - space) * c + space * d) + 1
+    def msg_tokens(self, msg):
+        '''raw_msgs 中一条消息的 token 数，缓存在消息上，prompt 被替换（如压缩）后自动重算'''
+        hit = msg.get('_tok')
+        if hit is None or hit[0] is not msg['prompt']: hit = msg['_tok'] = (msg['prompt'], self._count(msg['prompt']))
+        return hit[1]
+
+def family_of(model):
+    m = (model or '').lower()
+    for key, fam in (('claude', 'claude'), ('gpt', 'openai'), ('o1', 'openai'), ('o3', 'openai'), ('o4', 'openai'), ('gemini', 'gemini'),
+                     ('deepseek', 'cn'), ('qwen', 'cn'), ('kimi', 'cn'), ('moonshot', 'cn'), ('glm', 'cn'), ('minimax', 'cn')):
+        if key in m: return fam
+    return 'generic'
+
+_estimators = {}
+def get_estimator(family):
+    if family not in _estimators: _estimators[family] = TokenEstimator(family)
+    return _estimators[family]
+
+_archives = set()
+atexit.register(lambda: [os.remove(p) for p in list(_archives) if os.path.exists(p)])
+
+def compact_prompt(text):
+    # 截短 <thinking>/<tool_use>/<tool_result> 块，只保留前 200 字
+    for tag in ('thinking', 'tool_use', 'tool_result'):
+        text = re.sub(
+            rf'(<{tag}>)([\s\S]*?)(</{tag}>)',
+            lambda m: m.group(1) + (m.group(2)[:200] + '...') + m.group(3) if len(m.group(2)) > 200 else m.group(0),
+            text
+        )
+    return text
+
+class MsgCompactor:
+    '''raw_msgs 的增量压缩状态：每轮只处理新增的消息和刚越过水位线（距末尾超过 keep_recent 条）的消息。
+    越过水位线的消息用 compact_prompt 截短，原文追加到磁盘 jsonl，msg['orig'] 只记录偏移（未截短的记 None）；
+    同时维护 token 总数（estimator.msg_tokens，每条消息只估计一次），以及可选的 convert(msg) 转换后的输出消息列表。
+    raw_msgs 被整体替换、截断或在前部插入（如摘要）时自动全量重建，已压缩的消息不会重复处理。
+    '''
+    def __init__(self, estimator, convert=None, keep_recent=4):
+        self.estimator, self.convert, self.keep_recent = estimator, convert, keep_recent
+        self.store_path = os.path.join(tempfile.gettempdir(), f"ga_msgs_{os.getpid()}_{id(self):x}.jsonl")
+        self.reset()
+    def reset(self):
+        self.seen, self.out, self.total, self.watermark = [], [], 0, 0
+    def sync(self, raw):
+        n = len(self.seen)
+        if n > len(raw) or (n and (raw[0] is not self.seen[0] or raw[n-1] is not self.seen[-1])): self.reset()
+        for m in raw[len(self.seen):]:
+            self.seen.append(m); self.total += self.estimator.msg_tokens(m)
+            if self.convert: self.out.append(self.convert(m))
+        while self.watermark < len(raw) - self.keep_recent:
+            m = raw[self.watermark]
+            if 'orig' not in m:
+                text = compact_prompt(m['prompt'])
+                m['orig'] = None
+                if text != m['prompt']:
+                    m['orig'] = self._archive(m)
+                    before = self.estimator.msg_tokens(m); m['prompt'] = text
+                    self.total += self.estimator.msg_tokens(m) - before
+                    if self.convert: self.out[self.watermark] = self.convert(m)
+            self.watermark += 1
+        return self.out[:]
+    def _archive(self, m):
+        with open(self.store_path, 'a', encoding='utf-8') as f:
+            off = f.tell(); f.write(json.dumps({"role": m['role'], "prompt": m['prompt']}, ensure_ascii=False) + "\n")
+        _archives.add(self.store_path)
+        return off
+    def load_orig(self, m):
+        '''取回压缩前的原文'''
+        if m.get('orig') is None: return m['prompt']
+        with open(self.store_path, 'r', encoding='utf-8') as f:
+            f.seek(m['orig']); return json.loads(f.readline())['prompt']
+
 class ClaudeSession:
-    def __init__(self, api_key, api_base, model="claude-opus", context_win=10000):
+    def __init__(self, api_key, api_base, model="claude-opus", context_win=10000, prompt_cache=True):
         self.api_key, self.api_base, self.default_model, self.context_win = api_key, api_base.rstrip('/'), model, context_win
         self.raw_msgs, self.lock = [], threading.Lock()
+        self.prompt_cache = prompt_cache    # 在稳定前缀上打 cache_control 断点，见 _mark_cache_breakpoints
+        self.usage_log = collections.deque(maxlen=200)   # 每轮的 usage 及缓存命中率
+        self.cache_stats = {"turns": 0, "input_tokens": 0, "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0, "output_tokens": 0}
+        self.context_epoch, self._trim_head = 0, None    # 裁剪窗口的起点消息变化（裁掉了更多早期消息）时加一
+        self._trim_start, self.trim_to = 0, 0.6
+        self.http = HTTPPool()
+        self.tokens = get_estimator('claude')
+        self.compactor = MsgCompactor(self.tokens)
     def _trim_messages(self, messages):
-        # 压缩4轮前的assistant消息：truncate <thinking>/<tool_use> 块
-        for i, msg in enumerate(messages):
-            if i < len(messages) - 4 and 'orig' not in msg:
-                msg['orig'] = msg['prompt']
-                for tag in ('thinking', 'tool_use', 'tool_result'):
-                    msg['prompt'] = re.sub(
-                        rf'(<{tag}>)([\s\S]*?)(</{tag}>)',
-                        lambda m: m.group(1) + (m.group(2)[:200] + '...') + m.group(3) if len(m.group(2)) > 200 else m.group(0),
-                        msg['prompt']
-                    )
-        total = sum(len(m['prompt']) for m in messages)
-        if total <= self.context_win * 4: return messages
-        target, current, result = self.context_win * 4 * 0.9, 0, []
-        for msg in reversed(messages):
-            if (msg_len := len(msg['prompt'])) + current <= target:
-                result.append(msg); current += msg_len
-            else: break
-        if current > 10000 * 4: print(f'[DEBUG] Whole context length {current//4}.')
-        return result[::-1] or messages[-2:]
+        # 压缩4轮前的assistant消息：truncate <thinking>/<tool_use> 块（增量，见 MsgCompactor）
+        self.compactor.sync(messages)
+        if self.compactor.total <= self.context_win: return messages
+        # 滞回裁剪：窗口超过 context_win 时一次裁到 trim_to 比例，之后几轮起点不动，提示缓存的前缀和 context_epoch 都保持稳定
+        start = self._trim_start
+        current = sum(self.tokens.msg_tokens(m) for m in messages[start:]) if start < len(messages) and messages[start] is self._trim_head else None
+        if current is None or current > self.context_win:
+            target, current, start = self.context_win * self.trim_to, 0, len(messages)
+            while start > 0 and (n := self.tokens.msg_tokens(messages[start-1])) + current <= target: current += n; start -= 1
+            start = max(0, min(start, len(messages) - 2))
+        if current > 10000: print(f'[DEBUG] Whole context length {current}.')
+        result, self._trim_start = messages[start:], start
+        if result[0] is not self._trim_head: self.context_epoch += 1; self._trim_head = result[0]   # 只有窗口起点变化才算模型侧历史被裁剪
+        return result
     def raw_ask(self, messages, model=None, temperature=0.5, max_tokens=4096):
         model = model or self.default_model
         headers = {"x-api-key": self.api_key, "Content-Type": "application/json", "anthropic-version": "2023-06-01"}
         payload = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens, "stream": True}
+        usage = {}
         try:
-            with requests.post(f"{self.api_base}/v1/messages", headers=headers, json=payload, stream=True, timeout=(5,60)) as r:
+            with self.http.post(f"{self.api_base}/v1/messages", headers=headers, json=payload, stream=True) as r:
                 r.raise_for_status()
                 for line in r.iter_lines():
                     if not line: continue
@@ -69,11 +213,41 @@ class ClaudeSession:
                         if obj.get("type") == "content_block_delta" and obj.get("delta", {}).get("type") == "text_delta":
                             text = obj["delta"].get("text", "")
                             if text: yield text
+                        elif obj.get("type") == "message_start": usage.update(obj.get("message", {}).get("usage") or {})
+                        elif obj.get("type") == "message_delta": usage.update(obj.get("usage") or {})
                     except: pass
         except Exception as e: yield f"Error: {str(e)}"
+        if usage: self._record_usage(usage)
+    def _record_usage(self, usage):
+        read, write, fresh = (usage.get(k) or 0 for k in ("cache_read_input_tokens", "cache_creation_input_tokens", "input_tokens"))
+        rate = read / (read + write + fresh) if read + write + fresh else 0.0
+        self.usage_log.append(dict(usage, hit_rate=round(rate, 3)))
+        self.cache_stats["turns"] += 1
+        for k in ("input_tokens", "cache_read_input_tokens", "cache_creation_input_tokens", "output_tokens"): self.cache_stats[k] += usage.get(k) or 0
+        print(f"[Cache] input tokens: {read} cached / {write} written / {fresh} uncached, hit rate {rate:.0%}")
+    def get_cache_stats(self):
+        st = dict(self.cache_stats)
+        total = st["input_tokens"] + st["cache_read_input_tokens"] + st["cache_creation_input_tokens"]
+        st["hit_rate"] = round(st["cache_read_input_tokens"] / total, 3) if total else 0.0
+        st["last_turn"] = self.usage_log[-1] if self.usage_log else None
+        return st
+    def _mark_cache_breakpoints(self, raw_list, trimmed, messages):
+        '''在稳定前缀上打缓存断点（最多 3 个，接口上限为 4 个）：窗口内最近一条带系统提示和工具协议的消息、
+        已压缩历史的最后一条（更早的消息之后不会再变）、以及当前最后一条（供下一轮读取）。
+        服务端会从断点向前查找已缓存的最长前缀；_trim_messages 的滞回裁剪保证窗口起点在多轮内不变。
+        '''
+        marks = {len(messages) - 1}
+        last_compacted = self.compactor.watermark - 1 - (len(raw_list) - len(trimmed))
+        if last_compacted >= 0: marks.add(last_compacted)
+        sys_idx = next((i for i in range(len(trimmed) - 1, -1, -1) if trimmed[i]['prompt'].startswith('=== SYSTEM ===')), None)
+        if sys_idx is not None: marks.add(sys_idx)
+        for i in sorted(marks):
+            messages[i]["content"] = [{"type": "text", "text": messages[i]["content"], "cache_control": {"type": "ephemeral"}}]
     def make_messages(self, raw_list):
         trimmed = self._trim_messages(raw_list)
-        return [{"role": m['role'], "content": m['prompt']} for m in trimmed]
+        messages = [{"role": m['role'], "content": m['prompt']} for m in trimmed]
+        if self.prompt_cache: self._mark_cache_breakpoints(raw_list, trimmed, messages)
+        return messages
     def ask(self, prompt, model=None, stream=False):
         def _ask_gen():
             content = ''
@@ -94,14 +268,17 @@ class LLMSession:
         self.context_win = context_win
         self.default_model = model
         self.lock = threading.Lock()
+        self.http = HTTPPool()
+        self.tokens = get_estimator(family_of(model))
+        self.compactor = MsgCompactor(self.tokens, convert=self._convert)
 
     def raw_ask(self, messages, model=None, temperature=0.5):
         if model is None: model = self.default_model
         headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json", "Accept": "text/event-stream"}
         payload = {"model": model, "messages": messages, "temperature": temperature, "stream": True}
         try:
-            with requests.post(f"{self.api_base}/chat/completions",
-                            headers=headers, json=payload, stream=True, timeout=(5, 60)) as r:
+            with self.http.post(f"{self.api_base}/chat/completions",
+                                headers=headers, json=payload, stream=True) as r:
                 r.raise_for_status()
                 buffer = ''
                 for line in r.iter_lines():
@@ -119,33 +296,25 @@ class LLMSession:
         except Exception as e:
             yield f"Error: {str(e)}"
 
+    def _convert(self, msg, omit_images=True):
+        prompt = msg['prompt']
+        if omit_images and msg['image']: return {"role": msg['role'], "content": "[Image omitted, if you needed it, ask me]\n" + prompt}
+        elif not omit_images and msg['image']:
+            return {"role": msg['role'], "content": [
+                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{msg['image']}"}},
+                {"type": "text", "text": prompt} ]}
+        return {"role": msg['role'], "content": prompt}
+
     def make_messages(self, raw_list, omit_images=True):
-        messages = []
-        for i, msg in enumerate(raw_list):
-            if i < len(raw_list) - 4 and 'orig' not in msg:
-                msg['orig'] = msg['prompt']
-                for tag in ('thinking', 'tool_use', 'tool_result'):
-                    msg['prompt'] = re.sub(
-                        rf'(<{tag}>)([\s\S]*?)(</{tag}>)',
-                        lambda m: m.group(1) + (m.group(2)[:200] + '...') + m.group(3) if len(m.group(2)) > 200 else m.group(0),
-                        msg['prompt']
-                    )
-            prompt = msg['prompt']
-            if omit_images and msg['image']: messages.append({"role": msg['role'], "content": "[Image omitted, if you needed it, ask me]\n" + prompt})
-            elif not omit_images and msg['image']:
-                messages.append({"role": msg['role'], "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{msg['image']}"}},
-                    {"type": "text", "text": prompt} ]})
-            else:
-                messages.append({"role": msg['role'], "content": prompt})
-        return messages
+        if omit_images: return self.compactor.sync(raw_list)
+        return [self._convert(msg, omit_images=False) for msg in raw_list]
        
     def summary_history(self, model=None):
         if model is None: model = self.default_model
         with self.lock:
             keep = 0; tok = 0
             for m in reversed(self.raw_msgs):
-                l = len(str(m))//4
+                l = self.tokens.msg_tokens(m)
                 if tok + l > self.context_win*0.2: break
                 tok += l; keep += 1
             keep = max(2, keep)
@@ -154,9 +323,9 @@ class LLMSession:
             p = "Summarize prev summary and prev conversations into compact memory (facts/decisions/constraints/open questions). Do NOT restate long schemas. The new summary should less than 1000 tokens. Permit dropping non-important things.\n"
             messages = self.make_messages(old, omit_images=True)
             messages += [{"role":"user", "content":p}]
-            msg_lens = [1000 if isinstance(m["content"], list) else len(str(m["content"]))//4 for m in messages]
+            msg_lens = [self.tokens.msg_tokens(m) for m in old]
             summary = ''.join(list(self.raw_ask(messages, model, temperature=0.1)))
-            print('[Debug] Summary length:', len(summary)//4, '; Orig context lengths:', str(msg_lens))
+            print('[Debug] Summary length:', self.tokens.count(summary), '; Orig context lengths:', str(msg_lens))
             if not summary.startswith("Error:"): 
                 self.raw_msgs.insert(0, {"role":"assistant", "prompt":"Prev summary:\n"+summary, "image":None})
             else: self.raw_msgs = old + self.raw_msgs   # 不做了，下次再做
@@ -169,14 +338,14 @@ class LLMSession:
                 self.raw_msgs.append({"role": "user", "prompt": prompt, "image": image_base64})
                 messages = self.make_messages(self.raw_msgs[:-1], omit_images=True)
                 messages += self.make_messages([self.raw_msgs[-1]], omit_images=False)
-                msg_lens = [1000 if isinstance(m["content"], list) else len(str(m["content"]))//4 for m in messages]
-                total_len = sum(msg_lens)   # estimate token count
+                last_len = self.tokens.msg_tokens(self.raw_msgs[-1]) + (self.tokens.IMAGE_TOKENS if image_base64 else 0)
+                total_len = self.compactor.total + last_len   # estimate token count
             gen = self.raw_ask(messages, model)
             for chunk in gen:
                 content += chunk; yield chunk
             if not content.startswith("Error:"):
                 self.raw_msgs.append({"role": "assistant", "prompt": content, "image": None})
-            if total_len > 5000: print(f"[Debug] Whole context length {total_len} {str(msg_lens)}.")
+            if total_len > 5000: print(f"[Debug] Whole context length {total_len} ({len(messages)} msgs, last {last_len}).")
             if total_len > self.context_win: 
                 yield '[NextWillSummary]'
                 threading.Thread(target=self.summary_history, daemon=True).start()
@@ -190,6 +359,7 @@ class GeminiSession:
         if not self.api_key: raise ValueError("google_api_key 未配置或为空，请在 mykey.py 中设置")
         self.default_model = default_model
         self.proxies = {"http":proxy, "https":proxy} if proxy else None
+        self.http = HTTPPool(timeout=60)
     def ask(self, prompt, model=None, stream=False):
         if model is None: model = self.default_model
         url = f"https://generativelanguage.googleapis.com/v1/models/{model}:generateContent?key={self.api_key}"
@@ -197,7 +367,7 @@ class GeminiSession:
         data = {"contents":[{"role":"user","parts":[{"text":prompt}]}]}
         try:
             kw = {"headers":headers, "json":data, "timeout":60, 'proxies': self.proxies}
-            r = requests.post(url, **kw)
+            r = self.http.post(url, **kw)
         except Exception as e:
             return f"[GeminiError] request failed: {e}"
         if r.status_code != 200:
@@ -229,68 +399,256 @@ class MockResponse:
     def __repr__(self):    
         return f"<MockResponse thinking={bool(self.thinking)}, content='{self.content}', tools={bool(self.tool_calls)}>"
 
+SUMMARY_TAG = '[NextWillSummary]'
+def is_error_chunk(chunk): return chunk.startswith(("Error:", "[GeminiError]"))
+
+class _Stream:
+    '''在后台线程中迭代一个后端的 backend.ask(stream=True)，块连同自身放入公共队列，结束时放入 None。
+    被放弃（出错后换后端、首块超时、对冲落败）时，在下一块处关闭生成器（会话不再追加 assistant 消息），
+    并撤回本轮写入该会话 raw_msgs 的 user/assistant 消息，保证其历史与未发送这一轮时一致。
+    '''
+    def __init__(self, backend, prompt, q):
+        self.backend, self.prompt, self.q = backend, prompt, q
+        self.content, self.cancelled, self.done, self.t0 = '', False, False, time.time()
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+    def _run(self):
+        gen = None
+        try:
+            gen = self.backend.ask(self.prompt, stream=True)
+            for chunk in gen:
+                if self.cancelled: break
+                self.content += chunk; self.q.put((self, chunk))
+        except Exception as e: self.q.put((self, f"Error: {e}"))
+        finally:
+            if hasattr(gen, 'close'): gen.close()
+            with self.lock:
+                self.done = True
+                if self.cancelled: self._rollback()
+            self.q.put((self, None))
+    def cancel(self):
+        with self.lock:
+            if self.cancelled: return
+            self.cancelled = True
+            if self.done: self._rollback()
+    def _rollback(self):
+        raw = getattr(self.backend, 'raw_msgs', None)
+        if raw is None: return
+        reply = self.content[:-len(SUMMARY_TAG)] if self.content.endswith(SUMMARY_TAG) else self.content
+        with getattr(self.backend, 'lock', None) or threading.Lock():
+            raw = self.backend.raw_msgs
+            if reply and raw and raw[-1]['role'] == 'assistant' and raw[-1]['prompt'] == reply: raw.pop()
+            if raw and raw[-1]['role'] == 'user' and raw[-1]['prompt'] == self.prompt: raw.pop()
+
+class BackendRouter:
+    '''ToolClient.backends 之上的路由（llm_failover 开启时）：当前后端报错、空回复或首块超过 ttft_timeout 秒未到时，自动转到下一个后端重发本轮。
+    hedge 模式下，当前后端的首块等待超过其历史首块延迟的 hedge_percentile 分位时，提前并发请求下一个后端，
+    先开始输出的一方胜出，另一方被取消并撤回本轮消息。ToolClient 每轮只发送增量提示，历史保存在会话的 raw_msgs 中，
+    因此只在有 raw_msgs 的会话（Claude/OpenAI 兼容）之间切换：换到的后端先复制当前后端的 raw_msgs，上下文不丢失；
+    Sider/Gemini 等无状态后端既不作为备用，作为当前后端时也不转移。胜出的后端记入 active，之后的轮次继续使用它。
+    备用后端原有的 raw_msgs 被替换前暂存在 stash 中，可用 restore_history 恢复。
+    '''
+    def __init__(self, backends, failover=None, ttft_timeout=None, hedge=None, hedge_percentile=None):
+        self.backends = backends
+        self.failover = mykeys.get("llm_failover", False) if failover is None else failover
+        self.ttft_timeout = ttft_timeout or mykeys.get("llm_ttft_timeout", 60)
+        self.hedge = mykeys.get("llm_hedge", False) if hedge is None else hedge
+        self.hedge_percentile = hedge_percentile or mykeys.get("llm_hedge_percentile", 0.9)
+        self.hedge_default, self.hedge_min = 10, 2   # 样本不足 5 个时的对冲等待；对冲等待下限（秒）
+        self.ttft = {}    # id(backend) -> deque[首块延迟]
+        self.stats = collections.defaultdict(lambda: {"requests": 0, "wins": 0, "errors": 0, "stalls": 0, "hedges": 0})
+        self.stash = {}   # id(backend) -> (backend, 被 copy_history 替换前的 raw_msgs)
+        self.active = backends[0] if backends else None
+
+    def _key(self, b): return f"{self.backends.index(b) if b in self.backends else '?'}:{getattr(b, 'default_model', type(b).__name__)}"
+
+    @staticmethod
+    def stateful(b): return getattr(b, 'raw_msgs', None) is not None
+
+    def hedge_delay(self, b):
+        xs = sorted(self.ttft.get(id(b), ()))
+        if len(xs) < 5: return self.hedge_default
+        return max(self.hedge_min, xs[min(len(xs) - 1, int(len(xs) * self.hedge_percentile))])
+
+    def copy_history(self, src, dst, prompt):
+        '''dst 的 raw_msgs 换成 src 的副本（去掉 src 正在发送的本轮 user 消息），dst 原有的历史暂存到 stash。
+        已压缩消息的原文转存到 dst 自己的归档（msg['orig'] 是各会话归档文件内的偏移），token 缓存因估计器可能不同而不复制。
+        '''
+        if src is dst or not self.stateful(src) or not self.stateful(dst): return
+        with getattr(src, 'lock', None) or threading.Lock():
+            msgs = list(src.raw_msgs)
+        if msgs and msgs[-1]['role'] == 'user' and msgs[-1]['prompt'] == prompt: msgs.pop()
+        sc, dc = getattr(src, 'compactor', None), getattr(dst, 'compactor', None)
+        out = []
+        for m in msgs:
+            n = {"role": m['role'], "prompt": m['prompt'], "image": m.get('image')}
+            if 'orig' in m and dc is not None:
+                n['orig'] = None if m['orig'] is None or sc is None else dc._archive({"role": m['role'], "prompt": sc.load_orig(m)})
+            out.append(n)
+        with getattr(dst, 'lock', None) or threading.Lock():
+            old, dst.raw_msgs = dst.raw_msgs, out
+        if old and id(dst) not in self.stash:
+            self.stash[id(dst)] = (dst, old)
+            print(f"[Router] {self._key(dst)} 原有的 {len(old)} 条历史已暂存，可用 ToolClient.router.restore_history 恢复")
+
+    def restore_history(self, b):
+        '''把 b 的 raw_msgs 恢复为第一次被 copy_history 替换前的内容'''
+        hit = self.stash.pop(id(b), None)
+        if hit is None: return False
+        with getattr(b, 'lock', None) or threading.Lock(): b.raw_msgs = hit[1]
+        return True
+
+    def ask(self, primary, prompt):
+        '''生成器，产出胜出后端的流式输出；结束后 self.active 为胜出（或最后一个失败）的后端'''
+        self.active = primary
+        self.stats[self._key(primary)]["requests"] += 1
+        order = [primary] + [b for b in self.backends if b is not primary and self.stateful(b)]
+        if not self.failover or len(order) < 2 or not self.stateful(primary):
+            yield from primary.ask(prompt, stream=True); return
+        q, live, nxt = queue.Queue(), [], 1
+        live.append(_Stream(primary, prompt, q))
+        deadline, hedge_at = time.time() + self.ttft_timeout, time.time() + self.hedge_delay(primary)
+        def launch(why):
+            nonlocal nxt, deadline
+            if nxt >= len(order): return None
+            b = order[nxt]; nxt += 1
+            print(f"[Router] {why}, sending this turn to {self._key(b)} as well" if why == 'hedge' else f"[Router] {why}, failing over to {self._key(b)}")
+            self.copy_history(primary, b, prompt)
+            self.stats[self._key(b)]["requests"] += 1
+            s = _Stream(b, prompt, q); live.append(s); deadline = time.time() + self.ttft_timeout
+            return s
+        winner, last_err = None, None
+        while winner is None:
+            now = time.time()
+            wait = min(deadline, hedge_at) if self.hedge and nxt < len(order) else deadline
+            try: s, chunk = q.get(timeout=max(0.01, wait - now))
+            except queue.Empty:
+                if self.hedge and nxt < len(order) and time.time() >= hedge_at and time.time() < deadline:
+                    self.stats[self._key(live[-1].backend)]["hedges"] += 1
+                    launch('hedge'); hedge_at = float('inf'); continue
+                stalled = [x for x in live if not x.cancelled]
+                for x in stalled: self.stats[self._key(x.backend)]["stalls"] += 1
+                more = launch(f"no first token from {self._key(stalled[-1].backend)} in {self.ttft_timeout}s")
+                for x in stalled: x.cancel()
+                if more is None:
+                    yield f"Error: no response from any backend within {self.ttft_timeout}s"; return
+                continue
+            if s.cancelled: continue
+            if chunk is not None and not is_error_chunk(chunk):
+                winner = s; break
+            if chunk is not None: last_err = chunk
+            self.stats[self._key(s.backend)]["errors"] += 1
+            if any(x is not s and not x.cancelled for x in live):
+                s.cancel(); continue    # 对冲中的另一方仍在等待
+            if launch(f"{self._key(s.backend)} failed ({(last_err or 'empty response')[:80]})") is None:
+                self.active = s.backend   # 全部失败：保留最后一个后端的本轮消息，与单后端出错时一致
+                yield last_err or "Error: empty response"; return
+            s.cancel()
+        for x in live:
+            if x is not winner: x.cancel()
+        b = self.active = winner.backend
+        self.ttft.setdefault(id(b), collections.deque(maxlen=50)).append(time.time() - winner.t0)
+        self.stats[self._key(b)]["wins"] += 1
+        if b is not primary: print(f"[Router] continuing with {self._key(b)}")
+        yield chunk
+        while True:
+            s, chunk = q.get()
+            if s is not winner: continue
+            if chunk is None: return
+            yield chunk
+
+    def get_stats(self):
+        out = {}
+        for k, st in self.stats.items():
+            b = next((b for b in self.backends if self._key(b) == k), None)
+            xs = sorted(self.ttft.get(id(b), ()))
+            out[k] = dict(st, ttft_p50=round(xs[len(xs) // 2], 2) if xs else None, ttft_p90=round(xs[int(len(xs) * 0.9)], 2) if xs else None)
+        return out
+
+PROTOCOL_PROMPT = """
+### 交互协议 (必须严格遵守，持续有效)
+请按照以下步骤思考并行动，标签之间需要回车换行：
+1. **思考**: 在 `<thinking>` 标签中先进行思考，分析现状和策略。
+2. **总结**: 在 `<summary>` 中输出*极为简短*的高度概括的单行（<30字）物理快照，包括上次工具调用结果获取的新信息+本次工具调用意图和预期。此内容将进入长期工作记忆，记录关键信息，严禁输出无实际信息增量的描述。
+3. **行动**: 如需调用工具，请在回复正文之后输出 **<tool_use>块**，然后结束，我会稍后给你返回<tool_result>块。多个互不依赖的调用（如同时读取多个文件）可连续输出多个<tool_use>块，结果按顺序合并返回。
+   格式: ```<tool_use>\n{{"name": "工具名", "arguments": {{参数}}}}\n</tool_use>\n```
+
+### 可用工具库（已挂载，持续有效）
+{tools_json}
+"""
+
 class ToolClient:
     def __init__(self, backends, auto_save_tokens=False):
         if isinstance(backends, list): self.backends = backends
         else: self.backends = [backends]
         self.backend = self.backends[0]
         self.auto_save_tokens = auto_save_tokens
-        self.last_tools = ''
+        self.last_tools = ''     # 上次完整发送的工具 schema 的哈希，置空即下轮重发
         self.total_cd_tokens = 0
+        self.tools_reminder_tokens = mykeys.get("tools_reminder_tokens", 1500)   # 累计发送这么多 token 后重发完整工具协议（原为 6000 字符）
+        self.context_epoch, self._ctx_seen = 0, None   # 模型侧历史被摘要/裁剪、换后端，或后端不保存历史时加一
+        self._tools_cache = {}
+        self.router = BackendRouter(self.backends)
+
+    def get_http_stats(self):
+        return {f"{i}:{b.default_model}": b.http.get_stats() for i, b in enumerate(self.backends) if hasattr(b, 'http')}
 
     def chat(self, messages, tools=None):
         full_prompt = self._build_protocol_prompt(messages, tools)      
         print("Full prompt length:", len(full_prompt), 'chars')
         with open('model_responses.txt', 'a', encoding='utf-8', errors="replace") as f:
             f.write(f"=== Prompt ===\n{full_prompt}\n")
-        gen = self.backend.ask(full_prompt, stream=True)
-        raw_text = ''; summarytag = '[NextWillSummary]'
+        gen = self.router.ask(self.backend, full_prompt)
+        raw_text = ''; summarytag = SUMMARY_TAG
         for chunk in gen:
             raw_text += chunk; 
             if chunk != summarytag: yield chunk
+        self.backend = self.router.active
         print('Complete response received.')
-        if raw_text.endswith(summarytag):
+        summarized = raw_text.endswith(summarytag)
+        if summarized:
             self.last_tools = ''; raw_text = raw_text[:-len(summarytag)]
+        seen = (id(self.backend), getattr(self.backend, 'context_epoch', 0))
+        # Sider/Gemini 等不保存历史的后端每轮只看到当前提示，相当于每轮都重置了上下文
+        if summarized or seen != self._ctx_seen or not hasattr(self.backend, 'raw_msgs'): self.context_epoch += 1
+        self._ctx_seen = seen
         with open('model_responses.txt', 'a', encoding='utf-8', errors="replace") as f:
             f.write(f"=== Response ===\n{raw_text}\n\n")
         return self._parse_mixed_response(raw_text)
 
+    def _tool_instruction(self, tools):
+        '''按 schema 对象缓存工具 JSON 的哈希和完整的协议说明，schema 不变时不再重复 json.dumps；返回 (哈希, 协议说明)'''
+        hit = self._tools_cache.get(id(tools))
+        if hit is None or hit[0] is not tools:
+            tools_json = json.dumps(tools, ensure_ascii=False, separators=(',', ':'))
+            hit = (tools, hashlib.sha1(tools_json.encode('utf-8')).hexdigest(), PROTOCOL_PROMPT.format(tools_json=tools_json))
+            if len(self._tools_cache) >= 8: self._tools_cache.clear()
+            self._tools_cache[id(tools)] = hit
+        return hit[1:]
+
     def _build_protocol_prompt(self, messages, tools):
         system_content = next((m['content'] for m in messages if m['role'].lower() == 'system'), "")
         history_msgs = [m for m in messages if m['role'].lower() != 'system']
         # 构造工具描述
         tool_instruction = ""
         if tools:
-            tools_json = json.dumps(tools, ensure_ascii=False, separators=(',', ':'))
-            tool_instruction = f"""
-### 交互协议 (必须严格遵守，持续有效)
-请按照以下步骤思考并行动，标签之间需要回车换行：
-1. **思考**: 在 `<thinking>` 标签中先进行思考，分析现状和策略。
-2. **总结**: 在 `<summary>` 中输出*极为简短*的高度概括的单行（<30字）物理快照，包括上次工具调用结果获取的新信息+本次工具调用意图和预期。此内容将进入长期工作记忆，记录关键信息，严禁输出无实际信息增量的描述。
-3. **行动**: 如需调用工具，请在回复正文之后输出一个 **<tool_use>块**，然后结束，我会稍后给你返回<tool_result>块。
-   格式: ```<tool_use>\n{{"name": "工具名", "arguments": {{参数}}}}\n</tool_use>\n```
-
-### 可用工具库（已挂载，持续有效）
-{tools_json}
-"""
-            if self.auto_save_tokens and self.last_tools == tools_json:
+            tools_hash, tool_instruction = self._tool_instruction(tools)
+            if self.auto_save_tokens and self.last_tools == tools_hash:     # schema 未变且未到重发阈值，只发简短提示
                 tool_instruction = "\n### 工具库状态：持续有效（code_run/file_read等），**可正常调用**。调用协议沿用。\n"
             else:
                 self.total_cd_tokens = 0
-            self.last_tools = tools_json
+            self.last_tools = tools_hash
             
-        prompt = ""
-        if system_content: prompt += f"=== SYSTEM ===\n{system_content}\n"
-        prompt += f"{tool_instruction}\n\n"
+        parts = [f"=== SYSTEM ===\n{system_content}\n"] if system_content else []
+        parts += [tool_instruction, "\n\n"]
         for m in history_msgs:
-            role = "USER" if m['role'] == 'user' else "ASSISTANT"
-            prompt += f"=== {role} ===\n{m['content']}\n\n"
-            self.total_cd_tokens += len(m['content'])
-            
-        if self.total_cd_tokens > 6000: self.last_tools = ''
+            parts += ["=== USER ===\n" if m['role'] == 'user' else "=== ASSISTANT ===\n", m['content'], "\n\n"]
+        tokens = getattr(self.backend, 'tokens', None) or get_estimator(family_of(getattr(self.backend, 'default_model', '')))
+        self.total_cd_tokens += sum(tokens.count(m['content']) for m in history_msgs)
+        if self.total_cd_tokens > self.tools_reminder_tokens: self.last_tools = ''
 
-        prompt += "=== ASSISTANT ===\n" 
-        return prompt
+        parts.append("=== ASSISTANT ===\n")
+        return "".join(parts)
 
     def _parse_mixed_response(self, text):
         remaining_text = text
@@ -306,38 +664,45 @@ class ToolClient:
         tool_pattern = r"<tool_use>(.*?)</tool_use>"
         tool_all = re.findall(tool_pattern, remaining_text, re.DOTALL)
         
-        json_str = ""
+        json_strs = []
         if tool_all:
-            json_str = tool_all[-1].strip()
+            json_strs = [x.strip() for x in tool_all]
             remaining_text = re.sub(tool_pattern, "", remaining_text, flags=re.DOTALL)
         elif '<tool_use>' in remaining_text:
             weaktoolstr = remaining_text.split('<tool_use>')[-1].strip()
             json_str = weaktoolstr if weaktoolstr.endswith('}') else ''
             if json_str == '' and '```' in weaktoolstr and weaktoolstr.split('```')[0].strip().endswith('}'):
                 json_str = weaktoolstr.split('```')[0].strip()
+            json_strs = [json_str]
             remaining_text = remaining_text.replace('<tool_use>'+weaktoolstr, "")
         elif '"name":' in remaining_text and '"arguments":' in remaining_text:
             json_match = re.search(r"(\{.*\"name\":.*?\})", remaining_text, re.DOTALL | re.MULTILINE)
             if json_match:
                 json_str = json_match.group(1).strip()
+                json_strs = [json_str]
                 remaining_text = remaining_text.replace(json_str, "").strip()
-        if json_str:
-            try:
-                data = tryparse(json_str)
-                func_name = data.get('name') or data.get('function') or data.get('tool')
-                args = data.get('arguments') or data.get('args') or data.get('params') or data.get('parameters')
-                if args is None: args = data
-                if func_name: tool_calls = [MockToolCall(func_name, args)]
-            except json.JSONDecodeError as e:
-                print("[Warn] Failed to parse tool_use JSON:", json_str)
-                tool_calls = [MockToolCall('bad_json', {'msg': f'Failed to parse tool_use JSON: {json_str[:200]}'})]
-            except Exception as e:
-                print("[Error] Exception during tool_use parsing:", str(e), data)
+        for json_str in filter(None, json_strs):
+            call = self._parse_tool_json(json_str)
+            if call: tool_calls = (tool_calls or []) + [call]
 
         content = remaining_text.strip()
         if not content: content = ""
         return MockResponse(thinking, content, tool_calls, text)
 
+    def _parse_tool_json(self, json_str):
+        data = None
+        try:
+            data = tryparse(json_str)
+            func_name = data.get('name') or data.get('function') or data.get('tool')
+            args = data.get('arguments') or data.get('args') or data.get('params') or data.get('parameters')
+            if args is None: args = data
+            if func_name: return MockToolCall(func_name, args)
+        except json.JSONDecodeError as e:
+            print("[Warn] Failed to parse tool_use JSON:", json_str)
+            return MockToolCall('bad_json', {'msg': f'Failed to parse tool_use JSON: {json_str[:200]}'})
+        except Exception as e:
+            print("[Error] Exception during tool_use parsing:", str(e), data)
+
 def tryparse(json_str):
     try: return json.loads(json_str)
     except: pass
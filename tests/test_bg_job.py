@@ -0,0 +1,23 @@
+import os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pytest
+from ga import BgJob
+
+def alive(pid):
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    return True
+
+@pytest.mark.skipif(os.name == 'nt', reason='POSIX 进程组')
+def test_cancel_kills_grandchildren(tmp_path):
+    pid_file = tmp_path / 'pid'
+    job = BgJob('job_t', f'sleep 321 & echo $! > {pid_file}; wait', 'bash', str(tmp_path))
+    for _ in range(100):
+        if pid_file.exists() and pid_file.read_text().strip(): break
+        time.sleep(0.05)
+    pid = int(pid_file.read_text())
+    assert alive(pid)
+    assert job.cancel()['note'] == "[Stopped] 已取消"
+    deadline = time.time() + 5
+    while (alive(pid) or job.end_t is None) and time.time() < deadline: time.sleep(0.05)
+    assert not alive(pid) and job.end_t is not None
@@ -0,0 +1,51 @@
+import os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pytest
+from codesearch import SearchIndex, required_literals, fold, _signature, _trigram_hashes, dump_files, load_files
+
+def covers(data, literal):
+    m, bits = _signature(data)
+    mask = sum(1 << h for h in _trigram_hashes(fold(literal.encode('utf-8')), m))
+    return bits & mask == mask
+
+def test_required_literals():
+    assert required_literals('foo(bar', regex=False) == ['foo(bar']
+    assert required_literals(r'def\s+load_files\(', regex=True) == ['def', 'load_files(']
+    assert required_literals(r'abc|xyz', regex=True) == []
+    assert required_literals(r'ab.*cd', regex=True) == []      # 不足 3 字节的片段无法筛选
+    assert required_literals(r'(unclosed', regex=True) == []
+
+def test_signature_covers_literals():
+    data = 'class SearchIndex:\n    def candidates(self): pass\n'.encode('utf-8')
+    for lit in ('SearchIndex', 'searchindex', 'def candidates', 'pass'): assert covers(data, lit)
+    assert not covers(data, 'unique_marker_xyz')
+
+def test_signature_folds_non_ascii_case():
+    assert covers('ÄBC straße'.encode('utf-8'), 'äbc')
+    assert covers('Kſ'.encode('utf-8') + b'x', 'ksx')     # Kelvin K、长 s 在 IGNORECASE 下匹配 k/s
+
+def test_store_round_trip():
+    files = {'/a/b.py': (123, 456) + _signature(b'hello world'), '/a/\udcff.txt': (1, 2) + _signature(b'xyz')}
+    assert load_files(dump_files(files)) == files
+    for bad in (b'\x80\x03}q\x00.', dump_files(files)[:-3]):
+        with pytest.raises(ValueError): load_files(bad)
+
+def test_search_sees_external_changes(tmp_path):
+    (tmp_path / 'a.py').write_text('print(1)\n', encoding='utf-8')
+    index = SearchIndex(str(tmp_path / 'idx' / 'store.idx'), refresh_interval=3600)
+    assert index.search([str(tmp_path)], 'print')['matched_files'] == 1
+    (tmp_path / 'b.py').write_text('x = "unique_marker_xyz"\n', encoding='utf-8')   # 绕过 update_file 的外部修改
+    res = index.search([str(tmp_path)], 'unique_marker_xyz')
+    assert [os.path.basename(p) for _, _, p, _ in res['results']] == ['b.py']
+    (tmp_path / 'c.py').write_text('# unique_marker_xyz again\n', encoding='utf-8')   # 已有其他文件命中时新文件也要出现
+    res = index.search([str(tmp_path)], 'unique_marker_xyz')
+    assert sorted(os.path.basename(p) for _, _, p, _ in res['results']) == ['b.py', 'c.py']
+    (tmp_path / 'a.py').write_text('print(1)\nunique_marker_xyz = 2\n', encoding='utf-8')   # 只改内容，目录 mtime 不变
+    (tmp_path / 'b.py').write_text('x = 1\n', encoding='utf-8')
+    res = index.search([str(tmp_path)], 'unique_marker_xyz')
+    assert sorted(os.path.basename(p) for _, _, p, _ in res['results']) == ['a.py', 'c.py']
+    assert index.search([str(tmp_path)], 'ÄBC')['matched_files'] == 0
+    (tmp_path / 'd.md').write_text('äbc\n', encoding='utf-8')
+    assert index.search([str(tmp_path)], 'ÄBC')['matched_files'] == 1
+    index.save()
+    assert SearchIndex(index.store_path).files == index.files
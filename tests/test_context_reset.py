@@ -0,0 +1,36 @@
+import os, sys, types
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.modules.setdefault('mykey', types.ModuleType('mykey'))    # sidercall 只从 mykey 读配置，测试不需要真实后端
+from sidercall import ToolClient
+from agent_loop import agent_runner_loop, exhaust
+from ga import GenericAgentHandler
+
+READ = '<summary>读取 a.txt</summary>\n<tool_use>\n{"name": "file_read", "arguments": {"path": "a.txt"}}\n</tool_use>'
+REPLIES = [READ, READ, '<summary>完成</summary>\n已读完。']
+
+class Stateless:
+    '''像 SiderLLMSession：每轮只看到当前提示'''
+    default_model = 'stateless'
+    def __init__(self): self.prompts, self.replies = [], iter(REPLIES)
+    def ask(self, prompt, stream=False):
+        self.prompts.append(prompt); return iter([next(self.replies)])
+
+class Stateful(Stateless):
+    default_model = 'stateful'
+    def __init__(self): super().__init__(); self.raw_msgs = []
+
+def run(backend, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'a.txt').write_text('hello\n', encoding='utf-8')
+    handler = GenericAgentHandler(None, ['[USER]: 之前的任务'], str(tmp_path))
+    exhaust(agent_runner_loop(ToolClient([backend]), 'sys', '读 a.txt', handler, [], max_turns=3, verbose=False))
+    return backend.prompts
+
+def test_stateful_backend_gets_delta_anchor_and_cache_hits(tmp_path, monkeypatch):
+    prompts = run(Stateful(), tmp_path, monkeypatch)
+    assert '[unchanged]' in prompts[2] and '新增部分' in prompts[2]
+
+def test_stateless_backend_gets_full_anchor_and_no_cache_hits(tmp_path, monkeypatch):
+    prompts = run(Stateless(), tmp_path, monkeypatch)
+    assert '[unchanged]' not in prompts[2] and '1|hello' in prompts[2]
+    assert '新增部分' not in prompts[2] and '[USER]: 之前的任务' in prompts[2]
@@ -0,0 +1,41 @@
+import os, sys, threading
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ga import file_read, file_read_batch, get_line_index
+
+def write_rows(path, n, start=1, mode='w'):
+    with open(path, mode, encoding='utf-8') as f: f.write(''.join(f'row {i:05d}\n' for i in range(start, start + n)))
+
+def test_concurrent_file_read(tmp_path):
+    p = str(tmp_path / 'big.txt'); write_rows(p, 60000)
+    bad = []
+    def worker(starts):
+        for s in starts:
+            if file_read(p, start=s, count=1) != f'{s}|row {s:05d}': bad.append(s)
+    threads = [threading.Thread(target=worker, args=(range(50000 - t * 997, 59000, 7919),)) for t in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert bad == []
+
+def test_batch_many_ranges_of_one_file(tmp_path):
+    p = tmp_path / 'big.txt'; write_rows(str(p), 60000)
+    starts = list(range(59000, 1000, -979))[:60]
+    res = file_read_batch([{"path": "big.txt", "start": s, "count": 1} for s in starts], cwd=str(tmp_path), max_files=60)
+    assert [t for _, t in res] == [f'{s}|row {s:05d}' for s in starts]
+
+def test_append_extends_index(tmp_path):
+    p = str(tmp_path / 'log.txt'); write_rows(p, 5000)
+    assert file_read(p, start=4999, count=1) == '4999|row 04999'
+    idx = get_line_index(p)
+    write_rows(p, 3000, start=5001, mode='a')
+    assert file_read(p, start=7999, count=2) == '7999|row 07999\n8000|row 08000'
+    assert get_line_index(p) is idx          # 只是追加：沿用原索引继续扫描
+
+def test_same_size_rewrite_rebuilds_index(tmp_path):
+    p = str(tmp_path / 'f.txt'); write_rows(p, 3000)
+    assert file_read(p, start=2500, count=1) == '2500|row 02500'
+    with open(p, encoding='utf-8') as f: text = f.read()
+    with open(p, 'w', encoding='utf-8') as f: f.write(text.replace('row 00010', 'row 00\n\n\n', 1))
+    assert file_read(p, start=2500, count=1) == '2500|row 02497'
+    with open(p, encoding='utf-8') as f: text = f.read()
+    with open(p, 'w', encoding='utf-8') as f: f.write(text.replace('row 00020', 'r20', 1) + 'more\n' * 10)   # 变长但前部也改了
+    assert file_read(p, start=2500, count=1) == '2500|row 02497'
@@ -0,0 +1,42 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from agent_loop import call_views, collect
+from ga import GenericAgentHandler
+
+class Reply:
+    def __init__(self, content): self.content, self.thinking, self.tool_calls, self.raw = content, '', None, content
+
+def dispatch_all(tmp_path, content, calls):
+    h = GenericAgentHandler(None, [], str(tmp_path))
+    rets = [collect(h.dispatch(n, a, v))[1] for (n, a), v in zip(calls, call_views(Reply(content), calls))]
+    return h, rets
+
+def test_file_write_skips_code_run_block(tmp_path):
+    content = "<summary>写配置并检查</summary>\n```json\n{\"a\": 1}\n```\n```python\nprint('check')\n```"
+    calls = [('file_write', {'path': 'conf.json'}), ('code_run', {'type': 'python'})]
+    h, rets = dispatch_all(tmp_path, content, calls)
+    assert rets[0].data['status'] == 'success'
+    assert (tmp_path / 'conf.json').read_text(encoding='utf-8') == '{"a": 1}'
+    assert h.history_info == ['[Agent] 写配置并检查']     # 每轮一条 summary
+
+def test_file_write_ambiguous_blocks_are_rejected(tmp_path):
+    content = "```text\none\n```\n```text\ntwo\n```"
+    calls = [('file_write', {'path': 'x.txt'}), ('file_read', {'path': 'x.txt'})]
+    _, rets = dispatch_all(tmp_path, content, calls)
+    assert rets[0].data['status'] == 'error' and not (tmp_path / 'x.txt').exists()
+
+def test_file_writes_take_file_content_in_order(tmp_path):
+    content = "<file_content>one</file_content>\n<file_content>two</file_content>"
+    _, rets = dispatch_all(tmp_path, content, [('file_write', {'path': 'a.txt'}), ('file_write', {'path': 'b.txt'})])
+    assert [(tmp_path / n).read_text(encoding='utf-8') for n in ('a.txt', 'b.txt')] == ['one', 'two']
+
+def test_code_timing_stats(tmp_path):
+    h = GenericAgentHandler(None, [], str(tmp_path))
+    for i in range(3):
+        collect(h.dispatch('code_run', {'type': 'python'}, Reply(f"```python\nprint({i})\n```")))
+    st = h.get_code_timing_stats()
+    assert list(st) == ['python'] and st['python']['runs'] == 3
+    assert 0 <= st['python']['first_output_median'] <= st['python']['duration_max']
+    h.code_timings.extend({"type": "bash", "duration": 0.1} for _ in range(500))
+    assert len(h.code_timings) == h.code_timings.maxlen
+    h.close()